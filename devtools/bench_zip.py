@@ -0,0 +1,43 @@
+'''
+Benchmark the zip builder of core.py with the compression policies of compress.py
+
+python3 bench_zip.py <path> [<workers> ...]
+'''
+
+import io
+import os
+import sys
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "main", "python"))
+import core # pylint: disable=C0413
+import compress # pylint: disable=C0413
+
+
+POLICIES = [
+    ('stored', dict(method='stored')),
+    ('deflated', dict(method='deflated')),
+    ('auto', dict()),
+    ('auto-fast', dict(level=1)),
+    ('auto-budget', dict(cpu_budget=0.01)),
+]
+
+
+def bench(path, workers, name, policy):
+    ''' zip path in memory and print throughput '''
+
+    with zipfile.ZipFile(io.BytesIO(), mode='w') as fh_zip:
+        stats = core.fill_zip(fh_zip, [path], policy, workers=workers)
+    if stats is None:
+        print("zip aborted, see log")
+        return
+    print("%-12s workers %-4s files %8d (%6d stored)  bytes %12d  compressed %12d (%5.1f%%)"
+          "  %7.2f sec  %8.1f MB/s"
+          % (name, workers, stats['files'], stats['stored'], stats['bytes'], stats['compressed'],
+             100.0 * stats['compressed'] / max(stats['bytes'], 1), stats['seconds'],
+             stats['bytes'] / max(stats['seconds'], 1e-6) / 1e6))
+
+
+for n_workers in [int(arg) for arg in sys.argv[2:]] or [1, os.cpu_count()]:
+    for policy_name, kwargs in POLICIES:
+        bench(sys.argv[1], n_workers, policy_name, compress.Policy(**kwargs))
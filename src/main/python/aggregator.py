@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2019 The TimeBags developers
+#
+# This file is part of the TimeBags software.
+#
+# It is subject to the license terms in the LICENSE file
+# found in the top-level directory of this distribution.
+#
+# No part of the TimeBags software, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms
+# contained in the LICENSE file.
+
+'''
+This file belong to [TimeBags Project](https://timebags.org)
+
+Local aggregator of OpenTimestamps stamps.
+
+Processes submit sha256 digests over a Unix socket, the aggregator collects
+them for an interval, stamps all of them under a single merkle tip with one
+calendars round trip (see ots.ots_stamp_digests) and returns to each process
+the ots file content of its digests.
+
+Protocol, integers are 4 bytes big endian:
+    request:  <n> <digest 1> ... <digest n>   (32 bytes each)
+    response: <len 1> <ots 1> ... <len n> <ots n>   (len 0 if stamping failed)
+'''
+
+import os
+import queue
+import struct
+import socket
+import logging
+import threading
+import socketserver
+from concurrent.futures import Future
+
+import settings
+import ots
+
+
+SOCKET_FILE = "ots.sock"
+DEF_INTERVAL = 1.0
+# seconds a process waits for its stamps: an interval and the calendars round trip
+CLIENT_TIMEOUT = 60
+DIGEST_SIZE = 32
+MAX_DIGESTS = 65536
+HEADER = struct.Struct('>I')
+
+
+
+def get_socket_pathfile():
+    ''' Get the pathfile of the aggregator socket '''
+
+    return os.path.join(settings.path_conf_dir(), SOCKET_FILE)
+
+
+def read_exactly(rfile, size):
+    ''' Read size bytes from rfile, EOFError if they are less '''
+
+    data = rfile.read(size)
+    if len(data) != size:
+        raise EOFError("expected %d bytes, got %d" % (size, len(data)))
+    return data
+
+
+
+def stamp_digests(digests, socket_pathfile=None, timeout=CLIENT_TIMEOUT):
+    ''' Stamp a list of sha256 digests through the aggregator, return the list
+        of ots files content (None for the failed ones), or None if the
+        aggregator is not running '''
+
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    if socket_pathfile is None:
+        socket_pathfile = get_socket_pathfile()
+    if not os.path.exists(socket_pathfile) or len(digests) > MAX_DIGESTS:
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_pathfile)
+            sock.sendall(HEADER.pack(len(digests)) + b''.join(digests))
+            with sock.makefile('rb') as rfile:
+                contents = []
+                for _ in digests:
+                    size = HEADER.unpack(read_exactly(rfile, HEADER.size))[0]
+                    contents.append(read_exactly(rfile, size) if size else None)
+    except (OSError, EOFError) as exp:
+        msg = "Aggregator %s not available: %s" % (socket_pathfile, exp)
+        logging.debug(msg)
+        return None
+
+    msg = "Aggregator stamped %d digests" % len(digests)
+    logging.debug(msg)
+    return contents
+
+
+
+class AggregatorHandler(socketserver.StreamRequestHandler):
+    ''' Handle the request of a process '''
+
+    def handle(self):
+        ''' Read the digests, wait for their stamps and send them back '''
+
+        try:
+            count = HEADER.unpack(read_exactly(self.rfile, HEADER.size))[0]
+            if count > MAX_DIGESTS:
+                raise ValueError("too many digests: %d" % count)
+            digests = [read_exactly(self.rfile, DIGEST_SIZE) for _ in range(count)]
+        except (EOFError, ValueError) as exp:
+            msg = "Bad aggregator request: %s" % exp
+            logging.warning(msg)
+            return
+
+        contents = self.server.aggregator.submit(digests).result()
+        self.wfile.write(b''.join(HEADER.pack(len(content or b'')) + (content or b'')
+                                  for content in contents))
+
+
+
+class AggregatorServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    ''' Unix socket server of an Aggregator '''
+
+    daemon_threads = True
+    # processes connect in bursts, e.g. a batch started by a script
+    request_queue_size = 128
+
+    def __init__(self, socket_pathfile, aggregator):
+        self.aggregator = aggregator
+        super().__init__(socket_pathfile, AggregatorHandler)
+
+
+
+class Aggregator():
+    ''' Collect digests and stamp them all together every interval seconds '''
+
+    def __init__(self, interval=DEF_INTERVAL, min_resp=ots.DEF_MIN_RESP,
+                 timeout=ots.DEF_TIMEOUT):
+        self.interval = interval
+        self.min_resp = min_resp
+        self.timeout = timeout
+        self.pending = queue.SimpleQueue() # (digests, future), ...
+        self.stop_event = threading.Event()
+        self.server = None
+        self.stats = {'requests': 0, 'digests': 0, 'rounds': 0, 'failed': 0}
+
+
+    def submit(self, digests):
+        ''' Add digests to the next round, return a Future of their ots contents '''
+
+        future = Future()
+        self.pending.put((digests, future))
+        return future
+
+
+    def flush(self):
+        ''' Stamp all the pending digests with a single calendars round trip '''
+
+        pending = []
+        while True:
+            try:
+                pending.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        if not pending:
+            return
+
+        all_digests = [digest for digests, _ in pending for digest in digests]
+        try:
+            contents = ots.ots_stamp_digests(all_digests, self.min_resp, self.timeout)
+        except Exception as exp: # pylint: disable=W0703
+            msg = "Aggregator failed stamping: %s" % exp
+            logging.error(msg)
+            contents = None
+
+        self.stats['requests'] += len(pending)
+        self.stats['digests'] += len(all_digests)
+        self.stats['rounds'] += 1
+        if contents is None:
+            self.stats['failed'] += 1
+            contents = [None] * len(all_digests)
+        msg = "Aggregator round: %d digests from %d requests" % (len(all_digests), len(pending))
+        logging.info(msg)
+
+        start = 0
+        for digests, future in pending:
+            future.set_result(contents[start:start + len(digests)])
+            start += len(digests)
+
+
+    def run(self):
+        ''' Flush every interval seconds until stop() '''
+
+        while not self.stop_event.wait(self.interval):
+            self.flush()
+        self.flush()
+
+
+    def serve(self, socket_pathfile=None):
+        ''' Serve the processes on a Unix socket until stop() '''
+
+        if socket_pathfile is None:
+            socket_pathfile = get_socket_pathfile()
+        # a socket file left by a dead aggregator
+        if os.path.exists(socket_pathfile):
+            os.remove(socket_pathfile)
+
+        self.server = AggregatorServer(socket_pathfile, self)
+        flusher = threading.Thread(target=self.run, name="aggregator")
+        flusher.start()
+        msg = "Aggregator listening on %s, interval %.1f sec." % (socket_pathfile, self.interval)
+        logging.info(msg)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stop_event.set()
+            flusher.join()
+            self.server.server_close()
+            os.remove(socket_pathfile)
+            msg = "Aggregator stopped: %s" % self.stats
+            logging.info(msg)
+
+
+    def stop(self):
+        ''' Stop serve(), from another thread '''
+
+        self.stop_event.set()
+        if self.server is not None:
+            self.server.shutdown()
@@ -44,45 +44,48 @@ The TimeBags implementation of an ASiC-S file contains the following objects:
         [OpenTimeStamps](https://opentimestamps.org) format/protocol, calculated
         over the "META-INF/timestamp.tst" file)
 
+Timebags stamped in batch mode share a single TimeStampToken, calculated over
+the root of a merkle tree of their dataobjects, each one with its inclusion
+path in META-INF/timestamp.tst.proof (see tst.get_batch_token)
+
 Also the archive level comment field in the ZIP header is used to identify the
 mimetype with the string "mimetype=application/vnd.etsi.asic-s+zip"
 '''
 
 import os.path
 import zipfile
-import tempfile
+import hashlib
 import logging
 import shutil
 import time
-from pathlib import Path
 
 import tst
 import ots
+import compress
+import zipio
+import integrity
+import bagindex
+import aggregator
 
 
 METAINF_DIR = "META-INF"
-TIMESTAMP = os.path.join("META-INF", "timestamp.tst")
+TIMESTAMP = METAINF_DIR + "/timestamp.tst"
 TIMESTAMP_OTS = TIMESTAMP + ".ots"
+TIMESTAMP_PROOF = TIMESTAMP + ".proof"
 
 MIMETYPE = "application/vnd.etsi.asic-s+zip"
 ZIPCOMMENT = "mimetype=application/vnd.etsi.asic-s+zip"
 
+CHUNK_SIZE = 1024 * 1024
+# bytes of replaced items and old central directories kept by updates in place
+MAX_OVERHEAD = 1024 * 1024
 
 
-def add_missing_items(tmpdir):
-    ''' Add missing items to complete ASIC-S '''
-
-
-    # add mimetype file if missed
-    mimetype_pf = os.path.join(tmpdir, "mimetype")
-    if not os.path.exists(mimetype_pf):
-        with open(mimetype_pf, mode='x') as mimetype_fd:
-            mimetype_fd.write(MIMETYPE)
 
-    # add META-INF dir if missed
-    if not os.path.isdir(os.path.join(tmpdir, "META-INF")):
-        os.makedirs(os.path.join(tmpdir, "META-INF"))
+def get_hashnames():
+    ''' Get the hash algorithms needed to timestamp a dataobject '''
 
+    return sorted(set([ots.HASHNAME] + tst.get_hashnames()))
 
 
 def get_new_name(pathfile):
@@ -100,49 +103,163 @@ def get_new_name(pathfile):
 
 
 
-def unzip(container, tmpdir):
-    ''' unzip container into directory '''
+def hash_fd(file_fd, hashnames):
+    ''' Get the dict hashname: digest of a file object, reading it in chunks,
+        accounted in the hashing throughput (see tst.get_hash_throughput) '''
+
+    start = time.time()
+    nbytes = 0
+    hashes = {hashname: hashlib.new(hashname) for hashname in hashnames}
+    for chunk in iter(lambda: file_fd.read(CHUNK_SIZE), b''):
+        for hashobj in hashes.values():
+            hashobj.update(chunk)
+        nbytes += len(chunk)
+    tst.add_hash_stats(nbytes, time.time() - start, hashnames)
+
+    return {hashname: hashobj.digest() for hashname, hashobj in hashes.items()}
+
+
+def hash_file(pathfile, hashnames):
+    ''' Get the dict hashname: digest of a file, reading it in chunks '''
+
+    with open(pathfile, mode='rb') as file_fd:
+        return hash_fd(file_fd, hashnames)
+
+
+
+def upgrade_batch(containers):
+    ''' Upgrade and process many ASiC-S containers all together: a pending
+        commitment shared by many ots is fetched once from its calendar '''
 
-    # extract all from zip preserving date and time
-    for item in container.infolist():
-        name, date_time = item.filename, item.date_time
-        name = os.path.join(tmpdir, name)
-        folder = os.path.dirname(name)
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        with open(name, mode='wb') as out_item:
-            with container.open(item.filename, mode='r') as zip_item:
-                out_item.write(zip_item.read())
-        date_time = time.mktime(date_time + (0, 0, -1))
-        os.utime(name, (date_time, date_time))
+    names = []
+    for container in containers:
+        with zipfile.ZipFile(container.pathfile, mode='r') as fh_zip:
+            container.load_items(fh_zip)
+        for arcname in (container.get_dat_ots_name(), TIMESTAMP_OTS):
+            if arcname in container.items:
+                names.append((container, arcname))
 
+    new_datas = ots.ots_upgrade_datas([(arcname, container.items[arcname])
+                                       for container, arcname in names])
+    upgraded = {container.pathfile: {} for container in containers}
+    for (container, arcname), new_data in zip(names, new_datas):
+        if new_data is not None:
+            upgraded[container.pathfile][arcname] = new_data
 
-def zipdir(new_pathfile, tmpdir):
-    ''' zip a directory '''
+    return [container.process_timestamps(force=True, upgraded=upgraded[container.pathfile])
+            for container in containers]
 
-    with zipfile.ZipFile(new_pathfile, mode='x') as new_zip:
-        # set ASIC-S comment
-        new_zip.comment = ZIPCOMMENT.encode()
-        # zip all files
-        for root, _, files in os.walk(tmpdir):
-            for leaf in files:
-                leaf_pf = os.path.join(root, leaf)
-                # remove tmpdir path from name in zip
-                leaf_zip = str(Path(leaf_pf).relative_to(tmpdir))
-                new_zip.write(leaf_pf, leaf_zip)
+
+
+def stamp_digests(digests, timeout=20):
+    ''' Stamp sha256 digests with a single calendars round trip, through the
+        local aggregator if it is running, return the list of ots or None '''
+
+    contents = aggregator.stamp_digests(digests)
+    if contents is None:
+        return ots.ots_stamp_digests(digests, timeout=timeout)
+    return contents if None not in contents else None
+
+
+def get_batch_tokens(containers, batch_tst=False, hedging=None):
+    ''' Get the ts tokens of many containers: [(token, date_time, info, proof), ...]
+        as in single mode, each token is verified on the digests of its
+        container and a token not valid is None, hedging are the hedge_delay
+        and parallel arguments of the TSA requests (see tst.get_token) '''
+
+    digests_list = [container.digests for container in containers]
+    if batch_tst:
+        token, date_time, info, proofs = tst.get_batch_token(digests_list, **(hedging or {}))
+        tokens = [(token, date_time, info, proof) for proof in proofs or [None] * len(containers)]
+    else:
+        tokens = [(token, date_time, info, None)
+                  for token, date_time, info in tst.get_tokens(digests_list, **(hedging or {}))]
+
+    for index, (container, (token, _, _, proof)) in enumerate(zip(containers, tokens)):
+        if token is not None and not tst.verify_token(token, container.digests, proof=proof):
+            msg = "Not valid tst for %s" % container.pathfile
+            logging.critical(msg)
+            tokens[index] = (None, None, None, None)
+    return tokens
+
+
+def add_timestamps_batch(containers, timeout=20, batch_tst=False, hedging=None):
+    ''' Timestamp many new ASiC-S containers all together, they must be
+        created with the digests of their dataobject: TSA connections are
+        reused and all the ots share a single calendars round trip,
+        with batch_tst a single tst is shared by all the containers '''
+
+    if not containers:
+        return
+
+    tokens = get_batch_tokens(containers, batch_tst, hedging)
+
+    # stamp the dataobjects and their tst under the same merkle tip
+    leaves = []
+    for container, (token, _, _, _) in zip(containers, tokens):
+        leaves.append(container.digests[ots.HASHNAME])
+        if token is not None:
+            leaves.append(hashlib.new(ots.HASHNAME, token).digest())
+    stamps = stamp_digests(leaves, timeout=timeout)
+    if stamps is None:
+        logging.critical("Failed ots of batch")
+    stamps = iter(stamps if stamps else [])
+
+    for container, (token, date_time, info, proof) in zip(containers, tokens):
+        items = {}
+        if token is not None:
+            items[TIMESTAMP] = token
+            container.status['dat-tst'] = (date_time, info)
+        if proof is not None:
+            items[TIMESTAMP_PROOF] = proof
+        dat_ots = next(stamps, None)
+        if dat_ots is not None:
+            items[container.get_dat_ots_name()] = dat_ots
+            container.status['dat-ots'] = ('PENDING', [])
+        tst_ots = next(stamps, None) if token is not None else None
+        if tst_ots is not None:
+            items[TIMESTAMP_OTS] = tst_ots
+            container.status['tst-ots'] = ('PENDING', [])
+        container.append_items(items)
+
+        if token is not None and tst_ots is not None:
+            container.status['result'] = 'PENDING'
+            container.save_status()
+        else:
+            # fall back to complete it by itself
+            container.process_timestamps()
 
 
 
 class ASiCS():
     ''' Class for managing ASiC-S files '''
 
-    def __init__(self, pathfile):
-        ''' Initialize ASiC-S container '''
+    # the state of the container, its items and their changes: more than pylint likes
+    # pylint: disable=R0902
+
+    def __init__(self, pathfile, digests=None, deep=True):
+        ''' Initialize ASiC-S container,
+            digests (hashname: digest) of the dataobject can be provided
+            when they are already known, e.g. computed while zipping,
+            deep=False skips the CRC check of the members (see integrity.py) '''
 
         self.pathfile = pathfile
+        self.deep = deep
+        # roll back an update in place interrupted by a crash,
+        # or wait for the one of another process
+        zipio.recover(self.pathfile, wait=True)
         self.valid = False
         self.dataobject = None
+        self.digests = digests if digests else {}
+        self.dataobject_size = None
         self.mimetype = ""
+        # arcname: content of all the items but the dataobject, see load_items()
+        self.items = {}
+        self.item_infos = {}
+        # arcnames of the items added or modified since load_items()
+        self.changed = set()
+        # dat-tst of the tst verified at the last check of this very file, see use_index()
+        self.checked_tst = None
         # result  = UNKNOWN | INCOMPLETE | PENDING | UPGRADED | CORRUPTED
         # asic-s  = description string to explain many cases of not valid asic-s
         # dat-tst = (<date_time>, <tsa-info>)
@@ -165,7 +282,7 @@ class ASiCS():
         with zipfile.ZipFile(self.pathfile) as container:
 
             # integrity check
-            if container.testzip() is not None:
+            if integrity.check(self.pathfile, container, self.deep) is not None:
                 self.status['asic-s'] = "%s is not a valid zip archive, " \
                             "it will be encapsulated as a dataobject" % self.pathfile
                 logging.debug(self.status['asic-s'])
@@ -220,33 +337,117 @@ class ASiCS():
                 else:
                     # 1. only one dataobjec; 2. size>0; 3. MIMETYPE absent or asic-s
                     self.valid = True
+                    self.dataobject_size = dataobject_size
                     self.status['asic-s'] = "%s is a valid ASiC-S container" % self.pathfile
 
         logging.info(self.status['asic-s'])
 
 
 
-    def add_timestamps(self, tmpdir):
-        ''' Add missing items to complete ASIC-S '''
+    def append_items(self, items):
+        ''' Append items (arcname: content) to the container,
+            adding mimetype and comment if they are missing '''
 
+        with zipfile.ZipFile(self.pathfile, mode='r') as container:
+            self.load_items(container)
+        for arcname, content in items.items():
+            self.set_item(arcname, content)
+        self.update_container()
 
-        data_pf = os.path.join(tmpdir, self.dataobject)
-        tst_pf = os.path.join(tmpdir, TIMESTAMP)
-        data_ots_pf = os.path.join(tmpdir, "META-INF", self.dataobject + ".ots")
-        tst_ots_pf = os.path.join(tmpdir, TIMESTAMP + ".ots")
 
-        # add tst
-        if not os.path.exists(tst_pf):
 
-            with open(data_pf, mode='rb') as data_object:
-                data = data_object.read()
+    def get_dat_ots_name(self):
+        ''' Get the arcname of the ots of the dataobject '''
+
+        return METAINF_DIR + "/" + self.dataobject + ".ots"
+
+
+
+    def load_items(self, container):
+        ''' Load all the items but the dataobject, they are the mimetype and the
+            timestamps: small whatever the size of the dataobject '''
+
+        self.items, self.item_infos, self.changed = {}, {}, set()
+        for item in container.infolist():
+            if item.filename == self.dataobject or item.is_dir():
+                continue
+            self.items[item.filename] = container.read(item)
+            self.item_infos[item.filename] = item
+
+        # add mimetype if missed
+        if "mimetype" not in self.items:
+            self.set_item("mimetype", MIMETYPE.encode())
+        # and the comment too
+        if container.comment != ZIPCOMMENT.encode():
+            self.changed.add(None)
+
+
+
+    def set_item(self, arcname, content):
+        ''' Add or replace an item '''
+
+        self.items[arcname] = content
+        self.changed.add(arcname)
+
+
+
+    def use_index(self, bags):
+        ''' Take the sha256 digest of the dataobject and the verified tst
+            from the index of bags if the file did not change since its last
+            check: the dataobject is not hashed nor the tst verified again.
+            Return True if done '''
+
+        row = bags.get_unchanged(self.pathfile)
+        if row is None or row['digest'] is None:
+            return False
+        status = bagindex.get_status(row)
+        # the tst was verified, unless missing or not valid
+        if status['dat-tst'][0] is None or status['result'] == 'CORRUPTED':
+            return False
+        self.digests[ots.HASHNAME] = bytes.fromhex(row['digest'])
+        self.checked_tst = status['dat-tst']
+        return True
+
+
+
+    def hash_dataobject(self, container):
+        ''' Get the digests of the dataobject needed by its timestamps,
+            streaming it from the container only if some are missing '''
+
+        if TIMESTAMP in self.items and self.checked_tst is not None:
+            # no tst to get nor to verify
+            hashnames = {ots.HASHNAME}
+        else:
+            hashnames = set(get_hashnames())
+            if TIMESTAMP in self.items:
+                hashnames.add(tst.get_hashname(self.items[TIMESTAMP]))
+        if self.get_dat_ots_name() in self.items:
+            hashnames.add(ots.get_file_hashname(self.items[self.get_dat_ots_name()]))
+
+        missing = hashnames.difference(self.digests)
+        if missing:
+            msg = "Hashing dataobject %s with %s" % (self.dataobject, sorted(missing))
+            logging.debug(msg)
+            with container.open(self.dataobject, mode='r') as dat_fd:
+                self.digests.update(hash_fd(dat_fd, missing))
+            msg = "Hashing throughput: %.1f MB/s" % tst.get_hash_throughput()
+            logging.info(msg)
+
 
-            if data: # if len(data) > 0:
 
-                token, date_time, info = tst.get_token(data)
+    def add_timestamps(self, hedging=None):
+        ''' Add missing items to complete ASIC-S, hedging are the hedge_delay
+            and parallel arguments of the TSA requests (see tst.get_token) '''
+
+
+        # add tst
+        if TIMESTAMP not in self.items:
+
+            if self.dataobject_size:
+
+                token, date_time, info = tst.get_token(digests=self.digests, **(hedging or {}))
                 if token is not None:
-                    with open(tst_pf, mode='xb') as tst_fd:
-                        tst_fd.write(token)
+                    self.set_item(TIMESTAMP, token)
                     self.status['dat-tst'] = (date_time, info)
                 else:
                     msg = "timestamping failed"
@@ -257,48 +458,48 @@ class ASiCS():
                 logging.critical(msg)
 
 
-        # add data ots
-        if not os.path.exists(data_ots_pf):
-            if ots.ots_stamp([data_pf], timeout=20):
-                self.status['dat-ots'] = ('PENDING', None)
-                msg = "Done ots of dataobject"
+        # add data ots and tst ots, stamped together under the same merkle tip:
+        # a single calendars round trip for both
+        # (if tst is present then move on adding or upgrading its ots)
+        stamps = []
+        dat_ots_name = self.get_dat_ots_name()
+        if dat_ots_name not in self.items:
+            stamps.append((dat_ots_name, 'dat-ots', self.digests[ots.HASHNAME]))
+        if TIMESTAMP in self.items and TIMESTAMP_OTS not in self.items:
+            tst_digest = hashlib.new(ots.HASHNAME, self.items[TIMESTAMP]).digest()
+            stamps.append((TIMESTAMP_OTS, 'tst-ots', tst_digest))
+        if not stamps:
+            return
+
+        contents = stamp_digests([digest for _, _, digest in stamps])
+        for arcname, key, _ in stamps:
+            if contents:
+                self.set_item(arcname, contents.pop(0))
+                self.status[key] = ('PENDING', [])
+                msg = "Done %s of %s" % (key, self.pathfile)
                 logging.debug(msg)
-                data_ots_new = os.path.join(tmpdir, self.dataobject + ".ots")
-                shutil.move(data_ots_new, data_ots_pf)
             else:
-                msg = "Failed ots of dataobject"
+                msg = "Failed %s of %s" % (key, self.pathfile)
                 logging.critical(msg)
 
 
-        # add tst ots
-        if os.path.exists(tst_pf):
-            # if tst is present then move on adding or upgrading ots
-            if not os.path.exists(tst_ots_pf):
-                if ots.ots_stamp([tst_pf], timeout=20):
-                    self.status['tst-ots'] = ('PENDING', [])
-                    msg = "Done ots of tst"
-                    logging.debug(msg)
-                else:
-                    msg = "Failed ots of tst"
-                    logging.critical(msg)
-
-
 
-    def verify_ots(self, tmpdir):
-        ''' Verify opentimestamps '''
-
-
-        data_ots_pf = os.path.join(tmpdir, "META-INF", self.dataobject + ".ots")
-        data_ots_tmp = os.path.join(tmpdir, self.dataobject + ".ots")
-        tst_ots_pf = os.path.join(tmpdir, TIMESTAMP + ".ots")
+    def verify_ots(self, upgrade=True):
+        ''' Verify opentimestamps, keeping the upgraded ones,
+            the ones just added are not upgraded: calendars can not have
+            their commitments in a bitcoin block yet '''
 
 
         # verify data ots
-        if os.path.exists(data_ots_pf):
-            shutil.move(data_ots_pf, data_ots_tmp)
-            res, att = ots.ots_verify(data_ots_tmp)
+        dat_ots_name = self.get_dat_ots_name()
+        res, att = None, []
+        if dat_ots_name in self.items:
+            res, att, new_data = ots.ots_verify_data(self.items[dat_ots_name],
+                                                     self.digests, dat_ots_name,
+                                                     upgrade and dat_ots_name not in self.changed)
+            if new_data is not None:
+                self.set_item(dat_ots_name, new_data)
             self.status['dat-ots'] = (res, att if att else [])
-            shutil.move(data_ots_tmp, data_ots_pf)
         else:
             self.status['dat-ots'] = (None, [])
         msg = "Verify dat-ots result: %s %s" % (res, att)
@@ -306,8 +507,12 @@ class ASiCS():
 
 
         # verify tst ots
-        if os.path.exists(tst_ots_pf):
-            res, att = ots.ots_upgrade(tst_ots_pf)
+        res, att = None, []
+        if TIMESTAMP_OTS in self.items:
+            res, att, new_data = ots.ots_upgrade_data(self.items[TIMESTAMP_OTS], TIMESTAMP_OTS,
+                                                      upgrade and TIMESTAMP_OTS not in self.changed)
+            if new_data is not None:
+                self.set_item(TIMESTAMP_OTS, new_data)
             self.status['tst-ots'] = (res, att if att else [])
         else:
             self.status['tst-ots'] = (None, [])
@@ -317,26 +522,21 @@ class ASiCS():
 
 
 
-    def check_timestamps_status(self, tmpdir):
+    def check_timestamps_status(self):
         ''' Check for timestamps status'''
 
 
-        data_pf = os.path.join(tmpdir, self.dataobject)
-        tst_pf = os.path.join(tmpdir, TIMESTAMP)
-        data_ots_pf = os.path.join(tmpdir, "META-INF", self.dataobject + ".ots")
-        tst_ots_pf = os.path.join(tmpdir, TIMESTAMP + ".ots")
-
-
-
-        if not os.path.exists(tst_pf):
+        if TIMESTAMP not in self.items:
 
             self.status['result'] = 'INCOMPLETE'
             logging.info('ASIC-S not completed')
             return
 
-        if tst.verify_tst(tst_pf, data_pf):
-            with open(tst_pf, mode='rb') as tst_fd:
-                self.status['dat-tst'] = tst.get_info(tst_fd.read())
+        if self.checked_tst is not None:
+            self.status['dat-tst'] = self.checked_tst
+        elif tst.verify_token(self.items[TIMESTAMP], self.digests,
+                              proof=self.items.get(TIMESTAMP_PROOF)):
+            self.status['dat-tst'] = tst.get_info(self.items[TIMESTAMP])
         else:
             self.status['result'] = 'CORRUPTED'
             msg = "Error: timestamp.tst file not valid!"
@@ -345,7 +545,7 @@ class ASiCS():
 
 
 
-        if not os.path.exists(data_ots_pf) or not os.path.exists(tst_ots_pf):
+        if self.get_dat_ots_name() not in self.items or TIMESTAMP_OTS not in self.items:
             self.status['result'] = 'INCOMPLETE'
             logging.info('ASIC-S not completed')
 
@@ -369,32 +569,146 @@ class ASiCS():
 
 
 
-    def process_timestamps(self):
-        ''' Process asic-s file content looking for timestamps:
-            add missing, upgrade/verify what already exists '''
+    def write_container(self, container, new_pathfile, policy=None):
+        ''' Write a new container with the items and the dataobject of container,
+            the dataobject is copied as it is: no decompression nor compression '''
 
-        with tempfile.TemporaryDirectory() as tmpdir:
+        if policy is None:
+            policy = compress.Policy()
 
-            with zipfile.ZipFile(self.pathfile, mode='r') as container:
+        with zipfile.ZipFile(new_pathfile, mode='x') as new_zip:
+            # set ASIC-S comment
+            new_zip.comment = ZIPCOMMENT.encode()
 
-                unzip(container, tmpdir)
+            # mimetype first and stored
+            new_zip.writestr(self.get_item_info("mimetype"), self.items["mimetype"])
 
-                # process to complete asic-s
-                add_missing_items(tmpdir)
-                self.check_timestamps_status(tmpdir)
-                if self.status['result'] == 'INCOMPLETE':
-                    self.add_timestamps(tmpdir)
-                    self.check_timestamps_status(tmpdir)
+            zipio.copy_member(new_zip, container, container.getinfo(self.dataobject))
 
-                # process to verify/upgrade
-                self.verify_ots(tmpdir)
-                self.check_timestamps_status(tmpdir)
+            for arcname in sorted(self.items):
+                if arcname == "mimetype":
+                    continue
+                zinfo = self.get_item_info(arcname)
+                policy.apply(zinfo, arcname, self.items[arcname])
+                new_zip.writestr(zinfo, self.items[arcname])
+
+
+
+    def get_item_info(self, arcname):
+        ''' Get a ZipInfo for an item, preserving date and time when it is unchanged '''
+
+        old_info = self.item_infos.get(arcname)
+        if old_info is None or arcname in self.changed:
+            zinfo = zipfile.ZipInfo(arcname, time.localtime()[0:6])
+            zinfo.external_attr = 0o644 << 16
+        else:
+            zinfo = zipfile.ZipInfo(arcname, old_info.date_time)
+            zinfo.external_attr = old_info.external_attr
+        return zinfo
 
+
+
+    def needs_rewrite(self, container):
+        ''' Check if the container must be written again from scratch
+            instead of being updated in place '''
+
+        # mimetype must be the first item
+        if "mimetype" in self.changed:
+            return True
+
+        # reclaim the space of the items replaced by the updates in place
+        overhead = os.path.getsize(self.pathfile) \
+                    - sum(item.compress_size for item in container.infolist())
+        msg = "%s overhead: %d bytes" % (self.pathfile, overhead)
+        logging.debug(msg)
+        return overhead > MAX_OVERHEAD
+
+
+
+    def update_container(self, policy=None):
+        ''' Write the changed items: appended in place, or the whole container
+            written again when it can not be updated in place (see needs_rewrite) '''
+
+        with zipfile.ZipFile(self.pathfile, mode='r') as container:
+            rewrite = self.needs_rewrite(container)
+            if rewrite:
                 new_pathfile = get_new_name(self.pathfile)
-                zipdir(new_pathfile, tmpdir)
+                self.write_container(container, new_pathfile, policy)
 
-            # replace old zip with the new one
+        old_key = integrity.get_key(self.pathfile)
+        if rewrite:
+            # replace old zip with the new one, made of the same checked members
             shutil.move(new_pathfile, self.pathfile)
+        else:
+            if policy is None:
+                policy = compress.Policy()
+            members = []
+            for arcname in sorted(name for name in self.changed if name is not None):
+                zinfo = self.get_item_info(arcname)
+                policy.apply(zinfo, arcname, self.items[arcname])
+                members.append((zinfo, self.items[arcname]))
+            zipio.update_zip(self.pathfile, members, ZIPCOMMENT.encode())
+        integrity.refresh(self.pathfile, old_key)
+
+
+
+    def save_status(self):
+        ''' Record the status in the index of bags '''
+
+        bags = bagindex.get_index()
+        if bags is not None:
+            bags.record(self.pathfile, self.status, self.digests.get(ots.HASHNAME))
+
+
+
+    def process_timestamps(self, force=False, upgraded=None, hedging=None):
+        ''' Process asic-s file content looking for timestamps:
+            add missing, upgrade/verify what already exists,
+            without extracting the container.
+            Nothing is written if nothing changed, only the changed items
+            are written when the container can be updated in place.
+            Nothing is verified if the index of bags proves that the file
+            did not change since it got a final result, or since it got
+            pending and it is not yet time to check it again, unless force.
+            upgraded (arcname: content) are ots already upgraded by
+            upgrade_batch(), calendars are not queried again when it is given,
+            hedging are the arguments of the TSA requests (see add_timestamps) '''
+
+        bags = bagindex.get_index()
+        if bags is not None and not force:
+            status = bags.lookup(self.pathfile)
+            if status is not None and (status['result'] in bagindex.FINAL_RESULTS or
+                                       status['result'] == 'PENDING' and
+                                       not bags.is_due(self.pathfile)):
+                self.status.update(status)
+                msg = "%s unchanged since its last check: %s" % (self.pathfile, status['result'])
+                logging.info(msg)
+                return self.status['result']
+
+        with zipfile.ZipFile(self.pathfile, mode='r') as container:
+
+            self.load_items(container)
+            for arcname, content in (upgraded or {}).items():
+                self.set_item(arcname, content)
+            self.hash_dataobject(container)
+
+            # process to complete asic-s
+            self.check_timestamps_status()
+            if self.status['result'] == 'INCOMPLETE':
+                self.add_timestamps(hedging)
+                self.check_timestamps_status()
+
+            # process to verify/upgrade
+            self.verify_ots(upgrade=upgraded is None)
+            self.check_timestamps_status()
+
+        if self.changed:
+            self.update_container()
+        else:
+            msg = "%s unchanged, nothing to write" % self.pathfile
+            logging.debug(msg)
+
+        self.save_status()
 
         ret = self.status['result']
         msg = "asic.process_timestamps() return value: %s" % ret
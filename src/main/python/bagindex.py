@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2019 The TimeBags developers
+#
+# This file is part of the TimeBags software.
+#
+# It is subject to the license terms in the LICENSE file
+# found in the top-level directory of this distribution.
+#
+# No part of the TimeBags software, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms
+# contained in the LICENSE file.
+
+'''
+This file belong to [TimeBags Project](https://timebags.org)
+
+Persistent index of the processed timebags, a SQLite database in the
+configuration dir with, for each bag:
+    - path and (size, mtime_ns, inode) of the file when it was checked
+    - sha256 digest of the dataobject
+    - the status fields of the ASiCS (result, asic-s, dat-tst, *-ots)
+    - first, last and next check time
+
+A bag whose file did not change since its last check, with a final result,
+does not need to be verified again, and the state of all the bags is known
+without opening them.
+'''
+
+import os
+import time
+import json
+import sqlite3
+import datetime
+import logging
+import threading
+
+import settings
+import integrity
+
+
+DB_FILE = "timebags.sqlite"
+
+# results that can not change while the file does not change
+FINAL_RESULTS = ('UPGRADED',)
+# results verified again whenever asked, but never scheduled: CORRUPTED depends
+# on the TSA configuration too, e.g. a token of a TSA without its certificate
+UNSCHEDULED_RESULTS = ('CORRUPTED',)
+# seconds to wait before checking again a bag with a not final, not pending result
+RECHECK = {'INCOMPLETE': 3600, 'UNKNOWN': 3600}
+
+# pending ots can be upgraded only when the calendars have their commitments
+# in a bitcoin block with some confirmations, usually a couple of hours
+CONFIRMATION_DELAY = 2 * 3600
+# then they are checked again after a fraction of their age: the older
+# a stamp the rarer the checks, between MIN_RECHECK and MAX_RECHECK
+BACKOFF = 0.5
+MIN_RECHECK = 10 * 60
+MAX_RECHECK = 24 * 3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS bags (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    digest TEXT,
+    result TEXT,
+    asic_s TEXT,
+    dat_tst TEXT,
+    dat_ots TEXT,
+    tst_ots TEXT,
+    first_check REAL,
+    last_check REAL,
+    next_check REAL
+);
+CREATE INDEX IF NOT EXISTS bags_result ON bags (result, first_check);
+CREATE INDEX IF NOT EXISTS bags_next_check ON bags (next_check);
+'''
+
+INDEX = None
+INDEX_LOCK = threading.Lock()
+
+
+
+def get_recheck(result, age):
+    ''' Get the seconds to wait before checking again a bag with result,
+        first checked age seconds ago, None if it does not need it '''
+
+    if result in FINAL_RESULTS or result in UNSCHEDULED_RESULTS:
+        return None
+    if result != 'PENDING':
+        return RECHECK.get(result, RECHECK['UNKNOWN'])
+    if age < CONFIRMATION_DELAY:
+        return CONFIRMATION_DELAY - age
+    return min(max(age * BACKOFF, MIN_RECHECK), MAX_RECHECK)
+
+
+def get_index():
+    ''' Get the index in the configuration dir, None if it is not available '''
+
+    global INDEX # pylint: disable=W0603
+    with INDEX_LOCK:
+        if INDEX is None and os.path.isdir(settings.path_conf_dir()):
+            try:
+                INDEX = BagIndex(os.path.join(settings.path_conf_dir(), DB_FILE))
+            except sqlite3.Error as exp:
+                msg = "Index of bags not available: %s" % exp
+                logging.warning(msg)
+    return INDEX
+
+
+
+class BagIndex():
+    ''' SQLite index of bags and their timestamps status '''
+
+    def __init__(self, pathfile):
+        ''' Open or create the index database pathfile '''
+
+        self.pathfile = pathfile
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(pathfile, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+
+
+    def close(self):
+        ''' Close the database '''
+
+        with self.lock:
+            self.conn.close()
+
+
+    def record(self, pathfile, status, digest=None, now=None):
+        ''' Record the status of the bag pathfile as checked now,
+            digest is the sha256 of its dataobject '''
+
+        if now is None:
+            now = time.time()
+        path, (size, mtime_ns, inode) = integrity.get_key(pathfile)
+        dat_tst = status['dat-tst']
+
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT first_check FROM bags WHERE path = ?",
+                                    (path,)).fetchone()
+            first_check = row[0] if row is not None else now
+            recheck = get_recheck(status['result'], now - first_check)
+            next_check = now + recheck if recheck is not None else None
+            self.conn.execute(
+                "INSERT INTO bags VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET size=excluded.size, "
+                "mtime_ns=excluded.mtime_ns, inode=excluded.inode, "
+                "digest=COALESCE(excluded.digest, digest), result=excluded.result, "
+                "asic_s=excluded.asic_s, dat_tst=excluded.dat_tst, "
+                "dat_ots=excluded.dat_ots, tst_ots=excluded.tst_ots, "
+                "last_check=excluded.last_check, next_check=excluded.next_check",
+                (path, size, mtime_ns, inode, digest.hex() if digest else None,
+                 status['result'], status['asic-s'],
+                 json.dumps([dat_tst[0].isoformat() if dat_tst[0] is not None else None,
+                             dat_tst[1]]),
+                 json.dumps(status['dat-ots']), json.dumps(status['tst-ots']),
+                 now, now, next_check))
+
+
+    def get(self, pathfile):
+        ''' Get the row of the bag pathfile or None '''
+
+        with self.lock:
+            return self.conn.execute("SELECT * FROM bags WHERE path = ?",
+                                     (os.path.realpath(pathfile),)).fetchone()
+
+
+    def get_unchanged(self, pathfile):
+        ''' Get the row of the bag pathfile if its file did not change
+            since its last check, otherwise None '''
+
+        row = self.get(pathfile)
+        if row is None:
+            return None
+        _, stat_key = integrity.get_key(pathfile)
+        if [row['size'], row['mtime_ns'], row['inode']] != stat_key:
+            return None
+        return row
+
+
+    def lookup(self, pathfile):
+        ''' Get the recorded status of the bag pathfile if its file
+            did not change since its last check, otherwise None '''
+
+        row = self.get_unchanged(pathfile)
+        return get_status(row) if row is not None else None
+
+
+    def query(self, result=None, older_than=None, now=None):
+        ''' Get the rows of the bags with result (all if None)
+            first checked more than older_than seconds ago '''
+
+        if now is None:
+            now = time.time()
+        sql, params = "SELECT * FROM bags WHERE 1", []
+        if result is not None:
+            sql += " AND result = ?"
+            params.append(result)
+        if older_than is not None:
+            sql += " AND first_check < ?"
+            params.append(now - older_than)
+        with self.lock:
+            return self.conn.execute(sql + " ORDER BY first_check", params).fetchall()
+
+
+    def due(self, now=None):
+        ''' Get the rows of the bags to be checked again by now '''
+
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return self.conn.execute("SELECT * FROM bags WHERE next_check <= ? "
+                                     "ORDER BY next_check", (now,)).fetchall()
+
+
+    def is_due(self, pathfile, now=None):
+        ''' Check if the bag pathfile has to be checked again by now '''
+
+        if now is None:
+            now = time.time()
+        row = self.get(pathfile)
+        return row is None or row['next_check'] is not None and row['next_check'] <= now
+
+
+    def next_wakeup(self):
+        ''' Get the time of the next check of a bag, None if none is needed '''
+
+        with self.lock:
+            return self.conn.execute("SELECT MIN(next_check) FROM bags").fetchone()[0]
+
+
+    def remove(self, pathfile):
+        ''' Forget the bag pathfile '''
+
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM bags WHERE path = ?", (os.path.realpath(pathfile),))
+
+
+
+def get_status(row):
+    ''' Get the ASiCS status dict from a row of the index '''
+
+    def get_ots(value):
+        state, attestations = json.loads(value)
+        return (state, [tuple(attestation) for attestation in attestations or []])
+
+    date_time, tsa = json.loads(row['dat_tst'])
+    if date_time is not None:
+        date_time = datetime.datetime.fromisoformat(date_time)
+    return {'result': row['result'], 'asic-s': row['asic_s'],
+            'dat-tst': (date_time, tsa),
+            'dat-ots': get_ots(row['dat_ots']), 'tst-ots': get_ots(row['tst_ots'])}
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2019 The TimeBags developers
+#
+# This file is part of the TimeBags software.
+#
+# It is subject to the license terms in the LICENSE file
+# found in the top-level directory of this distribution.
+#
+# No part of the TimeBags software, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms
+# contained in the LICENSE file.
+
+'''
+This file belong to [TimeBags Project](https://timebags.org)
+
+Compression policy for the members of the zip archives.
+
+Each member is STORED or DEFLATED (with a level) looking at:
+    - the file extension (already compressed formats are stored)
+    - the deflate ratio of a sample of its first bytes, a cheap estimate
+        of its entropy (random-like data is stored)
+    - an optional CPU budget, seconds of compression allowed per MB of input:
+        the deflate level is lowered when compression is slower than that,
+        and raised back when it is much faster (output is no more
+        reproducible when a budget is set)
+'''
+
+import os.path
+import threading
+import zipfile
+import zlib
+
+
+SAMPLE_SIZE = 16 * 1024
+MAX_RATIO = 0.95 # deflated / original size of the sample
+DEF_LEVEL = 6
+ADAPT_BYTES = 16 * 1024 * 1024
+
+STORED_EXTENSIONS = (
+    # archives
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.lz', '.lzma', '.zst', '.7z', '.rar',
+    '.jar', '.apk', '.asice', '.asics', '.sce', '.scs',
+    # images
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.jp2',
+    # audio and video
+    '.mp3', '.m4a', '.aac', '.ogg', '.oga', '.opus', '.flac',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm', '.ogv',
+    # zipped documents
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub',
+)
+
+METHODS = {'stored': zipfile.ZIP_STORED, 'deflated': zipfile.ZIP_DEFLATED}
+
+
+
+def get_ratio(sample):
+    ''' Ratio of the size of sample deflated at the fastest level to its size:
+        close to 1 for random-like data, computed by zlib without the GIL '''
+
+    if not sample:
+        return 0.0
+    return len(zlib.compress(sample, 1)) / len(sample)
+
+
+def get_policy(spec='auto', cpu_budget=None):
+    ''' Get the Policy of spec "method[:level]", e.g. "deflated:9",
+        ValueError if it is not valid '''
+
+    method, _, level = spec.partition(':')
+    level = int(level) if level else DEF_LEVEL
+    if not 0 <= level <= 9:
+        raise ValueError("compression level not in 0-9: %d" % level)
+    return Policy(method, level, cpu_budget=cpu_budget)
+
+
+def read_sample(name):
+    ''' read the first bytes of a file '''
+
+    with open(name, mode='rb') as sample_fd:
+        return sample_fd.read(SAMPLE_SIZE)
+
+
+
+class Policy():
+    ''' Choose compression method and level for each member of a zip '''
+
+    def __init__(self, method='auto', level=DEF_LEVEL, max_ratio=MAX_RATIO, cpu_budget=None):
+        ''' method = auto | stored | deflated
+            cpu_budget = None | max seconds of compression per MB of input '''
+
+        if method != 'auto' and method not in METHODS:
+            raise ValueError("unknown compression method: %s" % method)
+        self.method = method
+        self.level = level
+        self.max_level = level
+        self.max_ratio = max_ratio
+        self.cpu_budget = cpu_budget
+        self.lock = threading.Lock()
+        self.window = [0, 0.0] # bytes, seconds since last level change
+
+
+    def choose(self, name, sample):
+        ''' return (compress_type, level) for the file name given a sample of it '''
+
+        if self.method != 'auto':
+            return (METHODS[self.method], self.level)
+
+        if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+            return (zipfile.ZIP_STORED, None)
+
+        if len(sample) > 0 and get_ratio(sample) > self.max_ratio:
+            return (zipfile.ZIP_STORED, None)
+
+        with self.lock:
+            return (zipfile.ZIP_DEFLATED, self.level)
+
+
+    def apply(self, zinfo, name, sample=None):
+        ''' set compression of zinfo for the file name, reading a sample if needed '''
+
+        if sample is None:
+            sample = read_sample(name) if self.method == 'auto' else b''
+        zinfo.compress_type, level = self.choose(name, sample)
+        # ZipFile.open(zinfo, 'w') takes the level from here
+        zinfo._compresslevel = level # pylint: disable=W0212
+        return (zinfo.compress_type, level)
+
+
+    def record(self, nbytes, seconds):
+        ''' record the time spent compressing nbytes, adapting the level to the budget '''
+
+        if self.cpu_budget is None:
+            return
+
+        with self.lock:
+            self.window[0] += nbytes
+            self.window[1] += seconds
+            if self.window[0] < ADAPT_BYTES:
+                return
+
+            per_mb = self.window[1] / (self.window[0] / 1e6)
+            if per_mb > self.cpu_budget and self.level > 1:
+                self.level -= 1
+            elif per_mb < self.cpu_budget / 2 and self.level < self.max_level:
+                self.level += 1
+            self.window = [0, 0.0]
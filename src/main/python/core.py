@@ -15,15 +15,58 @@ This file belong to [TimeBags Project](https://timebags.org)
 '''
 
 import os.path
+import stat
+import time
+import zlib
 import zipfile
-import tempfile
+import hashlib
+import shutil
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager, nullcontext
 
 import asic
+import compress
+import zipio
 
 
-def add_to_zip(fh_zip, name, arcname=None):
-    ''' try adding a file to the zip archive '''
+DATAOBJECT = "dataobject.zip"
+CHUNK_SIZE = 1024 * 1024
+LARGE_FILE = 32 * 1024 * 1024
+MAX_INFLIGHT = 256 * 1024 * 1024
+
+
+
+class DigestWriter():
+    ''' File-like wrapper hashing all the bytes written through it '''
+
+    def __init__(self, fd, hashnames):
+        self.fd = fd
+        self.hashes = {hashname: hashlib.new(hashname) for hashname in hashnames}
+
+    def write(self, data):
+        ''' update hashes and write data '''
+
+        for hashobj in self.hashes.values():
+            hashobj.update(data)
+        return self.fd.write(data)
+
+    def flush(self):
+        ''' flush the wrapped file object '''
+
+        self.fd.flush()
+
+    def digests(self):
+        ''' get the dict hashname: digest of all bytes written '''
+
+        return {hashname: hashobj.digest() for hashname, hashobj in self.hashes.items()}
+
+
+
+def add_to_zip(fh_zip, name, arcname=None, hashnames=None, policy=None):
+    ''' try adding a file to the zip archive, compressed as the policy chooses,
+        return its digests if hashnames are provided '''
 
 
     if not os.path.isfile(name):
@@ -38,46 +81,295 @@ def add_to_zip(fh_zip, name, arcname=None):
         msg = "empty file %s" % name
         logging.warning(msg)
 
+    digests = {}
     try:
-        fh_zip.write(name, arcname=arcname)
+        if hashnames is None and policy is None:
+            fh_zip.write(name, arcname=arcname)
+        else:
+            # copy by hand to let the bytes pass through the hashes
+            zinfo = zipfile.ZipInfo.from_file(name, arcname)
+            if policy is None:
+                policy = compress.Policy(method='deflated' \
+                        if fh_zip.compression == zipfile.ZIP_DEFLATED else 'stored')
+            digests = write_member(fh_zip, name, zinfo, policy, hashnames or ())
     except OSError:
         logging.critical(msg)
         return False
 
     msg = "zipped %s" % name
     logging.info(msg)
-    return True
+    return digests if hashnames is not None else True
+
+
+def get_arcname(name):
+    ''' name in the zip archive, the same used by ZipFile.write() '''
+
+    arcname = os.path.normpath(os.path.splitdrive(name)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    return arcname
+
+
+def get_zipinfo(name, stat_result):
+    ''' build ZipInfo from an already known stat (no more syscalls) '''
+
+    date_time = time.localtime(stat_result.st_mtime)[0:6]
+    zinfo = zipfile.ZipInfo(get_arcname(name), date_time)
+    zinfo.external_attr = (stat_result.st_mode & 0xFFFF) << 16
+    zinfo.file_size = stat_result.st_size
+    return zinfo
+
+
+def scan_dir(path_dir):
+    ''' list (pathname, stat) of the files in a dir and its subdirs, in the
+        same top-down order of os.walk, but sorted and stat-ing once,
+        return None if a not valid file is found '''
+
+    found = []
+    dirs = [path_dir]
+    while dirs:
+        path_dir = dirs.pop()
+        try:
+            with os.scandir(path_dir) as dir_it:
+                entries = sorted(dir_it, key=lambda entry: entry.name)
+            subdirs = []
+            for entry in entries:
+                if entry.is_dir():
+                    # like os.walk, do not follow symlinks to dirs
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                    continue
+                stat_result = entry.stat()
+                if not stat.S_ISREG(stat_result.st_mode):
+                    msg = "non regular file %s" % entry.path
+                    logging.info(msg)
+                    return None
+                found.append((entry.path, stat_result))
+        except OSError as err:
+            logging.critical(str(err))
+            return None
+        dirs.extend(reversed(subdirs))
+    return found
+
+
+def scan_files(path_files):
+    ''' list (pathname, stat) of the files to zip, walking dirs with scandir,
+        return None if a not valid file is found '''
+
+    found = []
+    for name in path_files:
+
+        if os.path.isdir(name):
+            dir_found = scan_dir(name)
+            if dir_found is None:
+                return None
+            found.extend(dir_found)
+            continue
+
+        try:
+            stat_result = os.stat(name)
+        except OSError as err:
+            logging.critical(str(err))
+            return None
+        if not stat.S_ISREG(stat_result.st_mode):
+            msg = "non regular file %s" % name
+            logging.info(msg)
+            return None
+        found.append((name, stat_result))
+
+    return found
+
+
+def compress_member(name, zinfo, policy):
+    ''' read and compress a file, it runs in the pool of workers '''
+
+    with open(name, mode='rb') as src_fd:
+        data = src_fd.read()
+    _, level = policy.apply(zinfo, name, data[:compress.SAMPLE_SIZE])
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+        start = time.thread_time()
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+        policy.record(zinfo.file_size, time.thread_time() - start)
+    zinfo.compress_size = len(data)
+    return data
+
+
+def is_unchanged(zinfo, ref_info):
+    ''' True if the file of zinfo has the same path, size and mtime in reference,
+        mtime is compared with the 2 seconds resolution of the zip format '''
+
+    return ref_info is not None and not ref_info.is_dir() \
+            and ref_info.flag_bits & 0x1 == 0 \
+            and ref_info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) \
+            and ref_info.file_size == zinfo.file_size \
+            and ref_info.date_time[0:5] == zinfo.date_time[0:5] \
+            and ref_info.date_time[5] // 2 == zinfo.date_time[5] // 2
+
+
+@contextmanager
+def open_reference(pathzip):
+    ''' open the dataobject.zip of a previous asic-s as ZipFile,
+        yield None if it has not one '''
+
+    with open(pathzip, mode='rb') as bag_fd, zipfile.ZipFile(bag_fd) as bag_zip:
+        try:
+            zinfo = bag_zip.getinfo(DATAOBJECT)
+        except KeyError:
+            msg = "reference %s has not a %s" % (pathzip, DATAOBJECT)
+            logging.warning(msg)
+            yield None
+            return
+
+        if zinfo.compress_type == zipfile.ZIP_STORED:
+            # read the nested zip in place
+            dataobject_fd = zipio.MemberReader(bag_fd, zipio.get_data_offset(bag_fd, zinfo),
+                                               zinfo.file_size)
+        else:
+            # seekable too, but slower
+            dataobject_fd = bag_zip.open(zinfo)
+        with zipfile.ZipFile(dataobject_fd) as reference:
+            msg = "using %s of %s as reference" % (DATAOBJECT, pathzip)
+            logging.info(msg)
+            yield reference
+
+
+def write_member(fh_zip, name, zinfo, policy, hashnames=()):
+    ''' stream a (big) file into the zip archive, in the writer thread,
+        return the digests (hashname: digest) of its content '''
+
+    policy.apply(zinfo, name)
+    start = time.thread_time()
+    with open(name, mode='rb') as src_fd, fh_zip.open(zinfo, mode='w') as dst_fd:
+        digest_fd = DigestWriter(dst_fd, hashnames)
+        shutil.copyfileobj(src_fd, digest_fd, CHUNK_SIZE)
+    if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+        policy.record(zinfo.file_size, time.thread_time() - start)
+    return digest_fd.digests()
+
+
+def schedule_member(pool, name, stat_result, policy, reference):
+    ''' schedule a file to be written by write_job(), return the member
+        (name, zinfo, job): job is None to stream the file, the ZipInfo of
+        the same unchanged file in reference to copy it as it is,
+        or the Future of its compressed data '''
+
+    zinfo = get_zipinfo(name, stat_result)
+    ref_info = reference.NameToInfo.get(zinfo.filename) if reference else None
+    if is_unchanged(zinfo, ref_info):
+        return (name, zinfo, ref_info)
+    if stat_result.st_size > LARGE_FILE:
+        return (name, zinfo, None)
+    return (name, zinfo, pool.submit(compress_member, name, zinfo, policy))
+
+
+def write_job(fh_zip, member, policy, reference):
+    ''' write a member (name, zinfo, job) scheduled by schedule_member() '''
+
+    name, zinfo, job = member
+    if zinfo.file_size == 0:
+        # NOTE : see add_to_zip()
+        msg = "empty file %s" % name
+        logging.warning(msg)
+    if job is None:
+        write_member(fh_zip, name, zinfo, policy)
+    elif isinstance(job, zipfile.ZipInfo):
+        zipio.copy_member(fh_zip, reference, job, zinfo)
+    else:
+        zipio.write_raw(fh_zip, zinfo, job.result())
+
+
+def add_stats(stats, member):
+    ''' account a member written by write_job() in the stats of fill_zip() '''
+
+    _, zinfo, job = member
+    stats['files'] += 1
+    stats['bytes'] += zinfo.file_size
+    stats['compressed'] += zinfo.compress_size
+    if isinstance(job, zipfile.ZipInfo):
+        stats['reused'] += 1
+    if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+        stats['deflated'] += 1
+    else:
+        stats['stored'] += 1
+
+
+def fill_zip(fh_zip, path_files, policy=None, workers=None, reference=None):
+    ''' add files, and the content of dirs, to an open zip archive
+
+        Files are compressed by a pool of threads (zlib releases the GIL)
+        and a single writer adds them to the archive in scan order, so the
+        result does not depend on the workers. Files bigger than LARGE_FILE
+        are streamed by the writer to keep memory bounded.
+        Compression of each file is chosen by policy (see compress.py).
+        If reference (the ZipFile of a previous dataobject) has a file with the
+        same path, size and mtime, its compressed data is copied as it is.
+        Return the stats dict or None if a not valid file is found. '''
+
+    if policy is None:
+        policy = compress.Policy()
+    start = time.time()
+    found = scan_files(path_files)
+    if not found:
+        return None
+
+    stats = {'files': 0, 'bytes': 0, 'compressed': 0, 'stored': 0, 'deflated': 0,
+             'reused': 0, 'seconds': 0.0}
+    pending = deque()
+    inflight = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        found = iter(found)
+        try:
+            while True:
+                # keep the pool busy, but bound the memory used by the results
+                while inflight < MAX_INFLIGHT:
+                    item = next(found, None)
+                    if item is None:
+                        break
+                    pending.append(schedule_member(pool, *item, policy, reference))
+                    if isinstance(pending[-1][2], Future):
+                        inflight += item[1].st_size
+                if not pending:
+                    break
+
+                member = pending.popleft()
+                write_job(fh_zip, member, policy, reference)
+                if isinstance(member[2], Future):
+                    inflight -= member[1].file_size
+                add_stats(stats, member)
+                msg = "zipped %s" % member[0]
+                logging.info(msg)
+
+        except (OSError, zipfile.BadZipFile) as err:
+            logging.critical(str(err))
+            for member in pending:
+                if isinstance(member[2], Future):
+                    member[2].cancel()
+            return None
+
+    stats['seconds'] = time.time() - start
+    msg = "zipped %d files (%d stored, %d deflated, %d reused), %d bytes in %.2f sec " \
+          "(%.1f MB/s, %d bytes compressed)" % \
+            (stats['files'], stats['stored'], stats['deflated'], stats['reused'], stats['bytes'],
+             stats['seconds'], stats['bytes'] / max(stats['seconds'], 1e-6) / 1e6,
+             stats['compressed'])
+    logging.info(msg)
+    return stats
 
 
-def create_zip(path_zip, path_files):
+def create_zip(path_zip, path_files, policy=None, reference=None):
     ''' zip files '''
 
     with zipfile.ZipFile(path_zip, mode='x') as fh_zip:
 
         msg = "creating zipfile %s" % path_zip
         logging.info(msg)
-        counter = 0
-        for name in path_files:
-
-            if os.path.isdir(name):
-                for root, _, files in os.walk(name):
-                    for leaf in files:
-                        path_leaf = os.path.join(root, leaf)
-                        if add_to_zip(fh_zip, path_leaf):
-                            counter += 1 # one more file stored
-                        else:
-                            counter = 0
-                            break
-
-            elif add_to_zip(fh_zip, name):
-                counter += 1 # one more file stored
-            else:
-                counter = 0
-                break
-
+        result = fill_zip(fh_zip, path_files, policy, reference=reference) is not None
 
     # check if there is some file stored
-    if counter == 0:
+    if not result:
         os.remove(path_zip)
         msg = "found not valid file, zip aborted"
         logging.critical(msg)
@@ -85,15 +377,34 @@ def create_zip(path_zip, path_files):
     return True
 
 
-def there_can_be_only_one(pathfiles, pathzip=None):
-    ''' asic-s MUST have a single dataobject (not empty)'''
+def stream_zip(fh_out, path_files, policy=None, reference=None):
+    ''' zip files writing the archive on a (not seekable) file object '''
+
+    # zipfile falls back to data descriptors when fh_out can't seek,
+    # so the archive is written in a single pass without temp files
+    with zipfile.ZipFile(fh_out, mode='w') as fh_zip:
+
+        logging.info("creating streamed zipfile")
+        result = fill_zip(fh_zip, path_files, policy, reference=reference) is not None
+
+    if not result:
+        msg = "found not valid file, zip aborted"
+        logging.critical(msg)
+    return result
+
+
+def there_can_be_only_one(pathfiles, pathzip=None, policy=None, reference=None):
+    ''' asic-s MUST have a single dataobject (not empty)
+        reference is an optional previous asic-s of the same files, whose
+        dataobject.zip entries are reused when unchanged (see fill_zip)
+        return (pathzip, digests of the dataobject) or (None, None) '''
 
 
     # if there is only an empty file, do not create an asic-s archive with it
     if len(pathfiles) == 1 and os.path.isfile(pathfiles[0]) and os.stat(pathfiles[0]).st_size == 0:
         msg = "can't create valid asic-s with an empty file(%s)" % pathfiles[0]
         logging.critical(msg)
-        return None
+        return (None, None)
 
     # if a new zipfile name is not provided build it
     if not pathzip:
@@ -121,64 +432,137 @@ def there_can_be_only_one(pathfiles, pathzip=None):
         # then, something nasty it's appening if we are here!
         raise Exception(msg)
 
-    # create the asic-s zip
+    # create the asic-s zip, hashing the dataobject while it is written
+    hashnames = asic.get_hashnames()
     result = False
+    digests = None
     with zipfile.ZipFile(pathzip, mode='x') as timebag_zip:
         msg = "creating new asic-s file %s" % pathzip
         logging.info(msg)
 
+        # mimetype first and stored, and the ASIC-S comment: the new asic-s
+        # is complete but the timestamps, that are appended in place
+        timebag_zip.comment = asic.ZIPCOMMENT.encode()
+        zinfo = zipfile.ZipInfo("mimetype", time.localtime(time.time())[0:6])
+        zinfo.external_attr = 0o644 << 16
+        timebag_zip.writestr(zinfo, asic.MIMETYPE.encode())
+
         if len(pathfiles) == 1 and not os.path.isdir(pathfiles[0]):
             # put inside the asic-s zip the single file
-            result = add_to_zip(timebag_zip, pathfiles[0], os.path.basename(pathfiles[0]))
+            digests = add_to_zip(timebag_zip, pathfiles[0], os.path.basename(pathfiles[0]),
+                                 hashnames, policy if policy else compress.Policy())
+            result = digests is not False
 
         else:
-            # put inside the asic-s zip a dataobject.zip with all that stuff
-            with tempfile.TemporaryDirectory() as tmpdir:
-                dataobject_path = os.path.join(tmpdir, "dataobject.zip")
-                result = create_zip(dataobject_path, pathfiles)
-                if result:
-                    result = add_to_zip(timebag_zip, dataobject_path, \
-                                        os.path.basename(dataobject_path))
+            # put inside the asic-s zip a dataobject.zip with all that stuff,
+            # streaming it straight into its member: every byte is written once
+            # and no temp space is needed (size is unknown, so force zip64);
+            # its content is already compressed so the member is stored
+            zinfo = zipfile.ZipInfo(DATAOBJECT, time.localtime(time.time())[0:6])
+            zinfo.compress_type = zipfile.ZIP_STORED
+            zinfo.external_attr = 0o644 << 16
+            with open_reference(reference) if reference else nullcontext() as ref_zip, \
+                 timebag_zip.open(zinfo, mode='w', force_zip64=True) as dataobject_fd:
+                digest_fd = DigestWriter(dataobject_fd, hashnames)
+                result = stream_zip(digest_fd, pathfiles, policy, ref_zip)
+            if result:
+                digests = digest_fd.digests()
+                msg = "zipped %s" % DATAOBJECT
+                logging.info(msg)
 
     # remove filezip if creation failed
     if not result:
         os.remove(pathzip)
         msg = "valid file not found in params (%s)" % pathfiles
         logging.critical(msg)
-        return None
+        return (None, None)
+
+    return (pathzip, digests)
+
+
+def batch(pathfiles, policy=None, batch_tst=False, hedging=None):
+    ''' Batch mode: a new asic-s for each pathfile, all timestamped together,
+        with batch_tst sharing a single tst (see tst.get_batch_token),
+        hedging are the hedge_delay and parallel of the TSA requests,
+        return the list of status (None where failed) in the same order '''
+
+
+    results = []
+    containers = []
+    for pathfile in pathfiles:
+
+        # an asic-s is processed by itself as in single mode
+        if not os.path.isdir(pathfile):
+            container = asic.ASiCS(pathfile)
+            if container.valid:
+                container.process_timestamps(hedging=hedging)
+                results.append(container)
+                continue
+
+        # every dataobject is hashed before any timestamp request
+        pathzip, digests = there_can_be_only_one([pathfile], policy=policy)
+        if pathzip is None:
+            results.append(None)
+            continue
+        container = asic.ASiCS(pathzip, digests, deep=False)
+        containers.append(container)
+        results.append(container)
+
+    asic.add_timestamps_batch(containers, batch_tst=batch_tst, hedging=hedging)
+
+    statuses = []
+    for container in results:
+        if container is None:
+            statuses.append(None)
+            continue
+        msg = "asic %s, result: %s" % (container.pathfile, container.status['result'])
+        logging.info(msg)
+        container.status['pathfile'] = container.pathfile
+        statuses.append(container.status)
 
-    return pathzip
+    return statuses
 
 
-def main(pathfiles, get_timebag_pathname=None):
-    ''' Main '''
+def main(pathfiles, get_timebag_pathname=None, policy=None, reference=None, hedging=None):
+    ''' Main, policy is the compression policy for new asic-s (see compress.py),
+        reference a previous asic-s to rebag incrementally and hedging the
+        hedge_delay and parallel arguments of the TSA requests (see tst.get_token) '''
 
 
     result_pathfile = None
+    digests = None
+    container = None
 
     # if there is only one param check for valid asic-s
     if len(pathfiles) == 1 and not os.path.isdir(pathfiles[0]):
         container = asic.ASiCS(pathfiles[0])
         if container.valid:
             result_pathfile = pathfiles[0]
+        else:
+            container = None
 
     # if it's not an asic-s, then create a new zip asic-s
     if result_pathfile is None:
         if get_timebag_pathname is None: # call came from CLI
-            result_pathfile = there_can_be_only_one(pathfiles)
+            result_pathfile, digests = there_can_be_only_one(pathfiles, policy=policy,
+                                                             reference=reference)
         else: # call came from GUI, use the dialog to get pathzip
             pathzip = get_timebag_pathname()
             if pathzip:
-                result_pathfile = there_can_be_only_one(pathfiles, pathzip)
+                result_pathfile, digests = there_can_be_only_one(pathfiles, pathzip, policy,
+                                                                 reference)
 
     # if success creating asic-s, then complete it with timestamps
+    # (a new asic-s comes with digests, so its dataobject is not hashed again,
+    # and it has just been written, so its members are not CRC checked)
     if result_pathfile is not None:
-        container = asic.ASiCS(result_pathfile)
+        if container is None:
+            container = asic.ASiCS(result_pathfile, digests, deep=False)
         msg = "asic %s, valid: %s, status: %s" % \
                 (result_pathfile, container.valid, container.status['asic-s'])
         logging.info(msg)
 
-        container.process_timestamps()
+        container.process_timestamps(hedging=hedging)
         msg = "asic %s, result: %s" % \
                 (result_pathfile, container.status['result'])
         logging.info(msg)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2019 The TimeBags developers
+#
+# This file is part of the TimeBags software.
+#
+# It is subject to the license terms in the LICENSE file
+# found in the top-level directory of this distribution.
+#
+# No part of the TimeBags software, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms
+# contained in the LICENSE file.
+
+'''
+This file belong to [TimeBags Project](https://timebags.org)
+
+Health of the remote endpoints (TSAs and calendars), persisted in a json
+file in the configuration dir. For each endpoint url:
+    - the outcome of the last WINDOW requests: latency or failure,
+        to get latency percentiles and error rate
+    - a circuit breaker: after FAILURES consecutive failures the endpoint
+        is not used for a cooldown, then one probe request is let through
+        (half-open): success closes the circuit, failure opens it again
+        doubling the cooldown
+
+Endpoints are ordered by expected latency, counting failures as timeouts,
+and the timeout of a request is derived from the p99 latency of the endpoint,
+the configured timeout becoming its upper bound.
+'''
+
+import os
+import time
+import json
+import atexit
+import logging
+import threading
+
+import settings
+
+
+HEALTH_FILE = "health.json"
+SAVE_INTERVAL = 10
+
+WINDOW = 100
+FAILURES = 3
+COOLDOWN = 60
+MAX_COOLDOWN = 3600
+
+DEF_TIMEOUT = 10
+MIN_SAMPLES = 10
+TIMEOUT_FACTOR = 2
+MIN_TIMEOUT = 2
+
+REGISTRY = None
+REGISTRY_LOCK = threading.Lock()
+
+
+
+def get_registry():
+    ''' Get the process wide registry, persisted if the configuration dir exists '''
+
+    global REGISTRY # pylint: disable=W0603
+    with REGISTRY_LOCK:
+        if REGISTRY is None:
+            pathfile = None
+            if os.path.isdir(settings.path_conf_dir()):
+                pathfile = os.path.join(settings.path_conf_dir(), HEALTH_FILE)
+            REGISTRY = HealthRegistry(pathfile)
+            atexit.register(REGISTRY.save, force=True)
+    return REGISTRY
+
+
+def percentile(values, fraction):
+    ''' Get the nearest rank percentile of a not empty list of values '''
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+
+class HealthRegistry():
+    ''' Latencies, error rates and circuit breakers of remote endpoints '''
+
+    def __init__(self, pathfile=None):
+        ''' pathfile is the json file to persist the registry, None to not persist it '''
+
+        self.pathfile = pathfile
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.saved = 0.0
+        if pathfile is not None and os.path.exists(pathfile):
+            try:
+                with open(pathfile, mode='r', encoding='utf-8') as health_fd:
+                    self.endpoints = json.load(health_fd)
+                for entry in self.endpoints.values():
+                    entry['probing'] = None
+            except (OSError, ValueError) as exp:
+                msg = "Health registry not loaded: %s" % exp
+                logging.warning(msg)
+
+
+    def get(self, url):
+        ''' Get the entry of an endpoint, creating it if needed (lock held) '''
+
+        entry = self.endpoints.get(url)
+        if entry is None:
+            entry = {'samples': [], 'failures': 0, 'opened': None,
+                     'cooldown': COOLDOWN, 'probing': None}
+            self.endpoints[url] = entry
+        return entry
+
+
+    def record(self, url, seconds, success, now=None):
+        ''' Record the outcome of a request to url that took seconds '''
+
+        if now is None:
+            now = time.time()
+        with self.lock:
+            entry = self.get(url)
+            entry['samples'] = (entry['samples'] + [seconds if success else None])[-WINDOW:]
+            if success:
+                if entry['opened'] is not None:
+                    msg = "Circuit of %s closed" % url
+                    logging.info(msg)
+                entry.update(failures=0, opened=None, cooldown=COOLDOWN, probing=None)
+            else:
+                entry['failures'] += 1
+                probing = entry['probing'] is not None
+                if probing:
+                    # failed probe: open again, for longer
+                    entry['cooldown'] = min(entry['cooldown'] * 2, MAX_COOLDOWN)
+                if probing or entry['failures'] >= FAILURES:
+                    if entry['opened'] is None or probing:
+                        msg = "Circuit of %s open for %d seconds" % (url, entry['cooldown'])
+                        logging.warning(msg)
+                    entry.update(opened=now, probing=None)
+        self.save(now)
+
+
+    def call(self, url, func, *args, ok_errors=(), **kwargs):
+        ''' Call func(*args, **kwargs) recording it as a request to url,
+            exceptions in ok_errors are answers of a working endpoint '''
+
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except ok_errors:
+            self.record(url, time.time() - start, True)
+            raise
+        except Exception:
+            self.record(url, time.time() - start, False)
+            raise
+        self.record(url, time.time() - start, True)
+        return result
+
+
+    def allow(self, url, now=None):
+        ''' Check if a request to url can be done: circuit closed, or open
+            since more than its cooldown and no other recent probe '''
+
+        if now is None:
+            now = time.time()
+        with self.lock:
+            entry = self.get(url)
+            if entry['opened'] is None:
+                return True
+            if now - entry['opened'] >= entry['cooldown'] and \
+               (entry['probing'] is None or now - entry['probing'] >= entry['cooldown']):
+                entry['probing'] = now
+                msg = "Circuit of %s half open, probing" % url
+                logging.info(msg)
+                return True
+            return False
+
+
+    def get_stats(self, url):
+        ''' Get (requests, error rate, p50, p99) of url, percentiles are None
+            when there are no successful requests '''
+
+        with self.lock:
+            samples = list(self.get(url)['samples'])
+        latencies = [sample for sample in samples if sample is not None]
+        error_rate = (len(samples) - len(latencies)) / len(samples) if samples else 0.0
+        if not latencies:
+            return (len(samples), error_rate, None, None)
+        return (len(samples), error_rate, percentile(latencies, 0.5), percentile(latencies, 0.99))
+
+
+    def get_timeout(self, url, default):
+        ''' Get the timeout for a request to url, from its p99 latency,
+            default when there are not enough samples and as upper bound '''
+
+        samples, error_rate, _, p99 = self.get_stats(url)
+        if p99 is None or samples * (1 - error_rate) < MIN_SAMPLES:
+            return default
+        return min(max(p99 * TIMEOUT_FACTOR, MIN_TIMEOUT), default)
+
+
+    def get_score(self, url, default_timeout):
+        ''' Get the expected latency of a request to url, failures cost a timeout '''
+
+        _, error_rate, p50, _ = self.get_stats(url)
+        timeout = self.get_timeout(url, default_timeout)
+        return (p50 if p50 is not None else 0.0) * (1 - error_rate) + error_rate * timeout
+
+
+    def select(self, items, count=None, key=None, default_timeout=DEF_TIMEOUT):
+        ''' Order items (urls, or anything with key(item) url) by score,
+            the ones with open circuit at the end, last resort: with count
+            only the ones needed to have count items are kept '''
+
+        key = key if key is not None else lambda item: item
+        ordered = sorted(items, key=lambda item: self.get_score(key(item), default_timeout))
+        allowed = [item for item in ordered if self.allow(key(item))]
+        others = [item for item in ordered if item not in allowed]
+        if count is not None:
+            others = others[0:max(0, count - len(allowed))]
+        return allowed + others
+
+
+    def save(self, now=None, force=False):
+        ''' Persist the registry, at most once every SAVE_INTERVAL seconds unless force '''
+
+        if self.pathfile is None:
+            return
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if not force and now - self.saved < SAVE_INTERVAL:
+                return
+            self.saved = now
+            try:
+                with open(self.pathfile + ".tmp", mode='w', encoding='utf-8') as health_fd:
+                    json.dump(self.endpoints, health_fd)
+                os.replace(self.pathfile + ".tmp", self.pathfile)
+            except OSError as exp:
+                msg = "Health registry not saved: %s" % exp
+                logging.warning(msg)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2019 The TimeBags developers
+#
+# This file is part of the TimeBags software.
+#
+# It is subject to the license terms in the LICENSE file
+# found in the top-level directory of this distribution.
+#
+# No part of the TimeBags software, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms
+# contained in the LICENSE file.
+
+'''
+This file belong to [TimeBags Project](https://timebags.org)
+
+Integrity check of zip archives, in two passes:
+    - structure: the central directory against the local headers,
+        reading only a few bytes per member
+    - deep: decompression and CRC check of every member, in parallel
+
+Results are memoized per (path, size, mtime_ns, inode) in memory and
+in a json file in the configuration dir, so checking again an archive
+that did not change is free, in the same run and across runs.
+The file is written at most every SAVE_INTERVAL seconds and at exit.
+'''
+
+import os
+import json
+import time
+import atexit
+import zlib
+import zipfile
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+import zipio
+
+
+CACHE_FILE = "integrity.json"
+CACHE_SIZE = 4096
+SAVE_INTERVAL = 10
+CHUNK_SIZE = 1024 * 1024
+
+DEEP = "deep"
+STRUCTURE = "structure"
+
+CACHE = None
+CACHE_LOCK = threading.Lock()
+# the cache has changes not saved yet, and when it was saved
+CACHE_DIRTY = False
+CACHE_SAVED = 0.0
+
+
+
+def get_cache_pathfile():
+    ''' Get the pathfile of the persistent cache '''
+
+    return os.path.join(settings.path_conf_dir(), CACHE_FILE)
+
+
+def load_cache():
+    ''' Get the cache, loading it the first time '''
+
+    global CACHE # pylint: disable=W0603
+    if CACHE is None:
+        CACHE = {}
+        try:
+            with open(get_cache_pathfile(), mode='r', encoding='utf-8') as cache_fd:
+                CACHE = json.load(cache_fd)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as exp:
+            msg = "Integrity cache not loaded: %s" % exp
+            logging.warning(msg)
+        atexit.register(save_cache, force=True)
+    return CACHE
+
+
+def save_cache(now=None, force=False):
+    ''' Write the changed cache atomically, if the configuration dir exists,
+        at most once every SAVE_INTERVAL seconds unless force '''
+
+    global CACHE_DIRTY, CACHE_SAVED # pylint: disable=W0603
+    if now is None:
+        now = time.time()
+    with CACHE_LOCK:
+        if not CACHE_DIRTY or not force and now - CACHE_SAVED < SAVE_INTERVAL:
+            return
+        if not os.path.isdir(settings.path_conf_dir()):
+            return
+        CACHE_DIRTY = False
+        CACHE_SAVED = now
+
+        # forget the oldest entries
+        while len(CACHE) > CACHE_SIZE:
+            del CACHE[next(iter(CACHE))]
+
+        cache_pathfile = get_cache_pathfile()
+        try:
+            with open(cache_pathfile + ".tmp", mode='w', encoding='utf-8') as cache_fd:
+                json.dump(CACHE, cache_fd)
+            os.replace(cache_pathfile + ".tmp", cache_pathfile)
+        except OSError as exp:
+            msg = "Integrity cache not saved: %s" % exp
+            logging.warning(msg)
+
+
+def get_key(pathfile):
+    ''' Get (path, [size, mtime_ns, inode]) identifying the content of a file '''
+
+    stat_result = os.stat(pathfile)
+    return (os.path.realpath(pathfile),
+            [stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino])
+
+
+def lookup(pathfile, deep):
+    ''' Get the memoized result (bad member or None), KeyError if unknown '''
+
+    path, stat_key = get_key(pathfile)
+    with CACHE_LOCK:
+        entry = load_cache().get(path)
+    if entry is None or entry[0:3] != stat_key:
+        raise KeyError(path)
+    # a bad archive is bad whatever the level of the check
+    if deep and entry[3] != DEEP and entry[4] is None:
+        raise KeyError(path)
+    return entry[4]
+
+
+def remember(pathfile, level, result):
+    ''' Memoize the result of a check of pathfile '''
+
+    global CACHE_DIRTY # pylint: disable=W0603
+    path, stat_key = get_key(pathfile)
+    with CACHE_LOCK:
+        cache = load_cache()
+        cache.pop(path, None)
+        cache[path] = stat_key + [level, result]
+        CACHE_DIRTY = True
+    save_cache()
+
+
+def refresh(pathfile, old_key):
+    ''' Keep a good result of pathfile after it was changed by appending
+        members already checked, e.g. updated in place by zipio.update_zip() '''
+
+    path, old_stat_key = old_key
+    with CACHE_LOCK:
+        entry = load_cache().get(path)
+    if entry is not None and entry[0:3] == old_stat_key and entry[4] is None:
+        remember(pathfile, entry[3], None)
+
+
+
+def check_structure(fh_zip):
+    ''' Check the central directory against the local headers,
+        return the name of the first bad member or None '''
+
+    for zinfo in fh_zip.infolist():
+        try:
+            offset = zipio.get_data_offset(fh_zip.fp, zinfo)
+        except zipfile.BadZipFile as exp:
+            logging.debug(str(exp))
+            return zinfo.filename
+        if offset + zinfo.compress_size > fh_zip.start_dir:
+            msg = "Data of %s overlaps the central directory" % zinfo.filename
+            logging.debug(msg)
+            return zinfo.filename
+    return None
+
+
+def check_member(pathfile, name):
+    ''' Decompress a member checking its CRC, return its name if bad or None '''
+
+    try:
+        with zipfile.ZipFile(pathfile) as fh_zip, fh_zip.open(name) as member:
+            while member.read(CHUNK_SIZE):
+                pass
+    except (zipfile.BadZipFile, zlib.error, EOFError, OSError) as exp:
+        msg = "Bad member %s: %s" % (name, exp)
+        logging.debug(msg)
+        return name
+    return None
+
+
+def check_crc(pathfile, names, workers=None):
+    ''' Check the CRC of members in parallel, return the first bad one or None '''
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for bad in pool.map(lambda name: check_member(pathfile, name), names):
+            if bad is not None:
+                return bad
+    return None
+
+
+def check(pathfile, fh_zip, deep=True, workers=None):
+    ''' Check the integrity of the zip pathfile opened in fh_zip,
+        return the name of the first bad member or None, like testzip() '''
+
+    try:
+        return lookup(pathfile, deep)
+    except KeyError:
+        pass
+
+    bad = check_structure(fh_zip)
+    level = STRUCTURE
+    if bad is None and deep:
+        bad = check_crc(pathfile, fh_zip.namelist(), workers)
+        level = DEEP
+    msg = "Integrity check (%s) of %s: %s" % (level, pathfile, bad if bad else "ok")
+    logging.debug(msg)
+
+    remember(pathfile, level, bad)
+    return bad
@@ -17,8 +17,10 @@ import logging
 import os
 import time
 import threading
-from queue import Queue, Empty
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urljoin, urlsplit
+
+import requests
 
 from bitcoin.core import b2x, b2lx
 from opentimestamps.bitcoin import BitcoinBlockHeaderAttestation
@@ -26,56 +28,209 @@ from opentimestamps.core.notary import PendingAttestation
 from opentimestamps.core.timestamp import DetachedTimestampFile, make_merkle_tree
 from opentimestamps.core.timestamp import OpAppend, OpSHA256, Timestamp
 from opentimestamps.core.serialize import StreamSerializationContext, BadMagicError
-from opentimestamps.core.serialize import StreamDeserializationContext, DeserializationError
+from opentimestamps.core.serialize import BytesSerializationContext
+from opentimestamps.core.serialize import DeserializationError
+from opentimestamps.core.serialize import BytesDeserializationContext
 import opentimestamps.calendar
 import otsclient
 
+import health
+import sessions
+
 
 DEF_MIN_RESP = 2
 DEF_TIMEOUT = 10
+CALENDAR_CONCURRENCY = 4
+MAX_RESPONSE = 10000
+POOL_MAX_HOSTS = 16
+POOL_IDLE_TIMEOUT = 300
+DEF_GRACE = 0
+SUBMIT_WORKERS = 16
+HASHNAME = OpSHA256.TAG_NAME
+
+CALENDAR_URLS = ['https://a.pool.opentimestamps.org',
+                 'https://b.pool.opentimestamps.org',
+                 'https://a.pool.eternitywall.com',
+                 'https://ots.btc.catallaxy.com']
+
+
+
+class SessionCalendar(opentimestamps.calendar.RemoteCalendar):
+    ''' RemoteCalendar requesting through a requests.Session,
+        to reuse the same connections to the calendar for many requests '''
+
+    def __init__(self, url, session, user_agent="python-opentimestamps"):
+        super().__init__(url, user_agent=user_agent)
+        self.session = session
+
+    def read_response(self, response, deadline=None):
+        ''' get the content of a response, not trusting its size nor its pace:
+            reading fails after deadline (a time.time() value) '''
+
+        # requests.HTTPError is an OSError, like the urllib errors of RemoteCalendar
+        if response.status_code != 200:
+            raise requests.HTTPError("Unknown response from calendar: %d"
+                                     % response.status_code, response=response)
+        # what a single socket read got, where urllib3 can tell it
+        read = getattr(response.raw, 'read1', response.raw.read)
+        content = b''
+        while len(content) <= MAX_RESPONSE:
+            if deadline is not None and time.time() > deadline:
+                raise requests.Timeout("Calendar response exceeded timeout", response=response)
+            chunk = read(MAX_RESPONSE + 1 - len(content), decode_content=True)
+            if not chunk:
+                break
+            content += chunk
+        if len(content) > MAX_RESPONSE:
+            raise requests.HTTPError("Calendar response exceeded size limit", response=response)
+        return content
+
+    def submit(self, digest, timeout=None):
+        ''' same as RemoteCalendar.submit() but using self.session: connecting
+            and each read are bounded by timeout, reading the answer fails
+            once timeout seconds passed since the call '''
+
+        deadline = time.time() + timeout if timeout else None
+        with self.session.post(urljoin(self.url, 'digest'), data=digest, stream=True,
+                               headers=self.request_headers, timeout=timeout) as response:
+            ctx = BytesDeserializationContext(self.read_response(response, deadline))
+        return Timestamp.deserialize(ctx, digest)
+
+    def get_timestamp(self, commitment, timeout=None):
+        ''' same as RemoteCalendar.get_timestamp() but using self.session,
+            with the timeout of submit() '''
+
+        deadline = time.time() + timeout if timeout else None
+        with self.session.get(urljoin(self.url, 'timestamp/' + b2x(commitment)), stream=True,
+                              headers=self.request_headers, timeout=timeout) as response:
+            if response.status_code == 404:
+                reason = response.raw.read(MAX_RESPONSE, decode_content=True)
+                reason = reason.decode(errors='replace').strip()[0:256]
+                raise opentimestamps.calendar.CommitmentNotFoundError(reason)
+            ctx = BytesDeserializationContext(self.read_response(response, deadline))
+        return Timestamp.deserialize(ctx, commitment)
+
+
+
+class CalendarPool():
+    ''' Process wide pool of keep-alive sessions, one for each calendar host,
+        the ones not used for idle_timeout seconds are closed '''
+
+    def __init__(self, max_hosts=POOL_MAX_HOSTS, idle_timeout=POOL_IDLE_TIMEOUT,
+                 max_connections=CALENDAR_CONCURRENCY):
+        self.max_hosts = max_hosts
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        self.sessions = {} # host: [session, last used time]
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+    def get_session(self, calendar_url):
+        ''' get the session for the host of calendar_url '''
+
+        host = urlsplit(calendar_url).netloc
+        now = time.time()
+        with self.lock:
+            self.evict(now)
+            entry = self.sessions.pop(host, None)
+            if entry is None:
+                self.stats['misses'] += 1
+                entry = [sessions.new_session(self.max_connections), now]
+            else:
+                self.stats['hits'] += 1
+                entry[1] = now
+            # the most recently used last
+            self.sessions[host] = entry
+            return entry[0]
+
+    def evict(self, now):
+        ''' close the idle sessions and the least recently used beyond max_hosts '''
+
+        for host in list(self.sessions):
+            session, last_used = self.sessions[host]
+            if now - last_used > self.idle_timeout or len(self.sessions) >= self.max_hosts:
+                del self.sessions[host]
+                session.close()
+                self.stats['evicted'] += 1
+
+    def get_stats(self):
+        ''' get hits, misses, evicted and open sessions '''
+
+        with self.lock:
+            return dict(self.stats, sessions=len(self.sessions))
+
+    def close(self):
+        ''' close all the sessions '''
+
+        with self.lock:
+            for session, _ in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+CALENDAR_POOL = CalendarPool()
+SUBMIT_POOL = ThreadPoolExecutor(max_workers=SUBMIT_WORKERS, thread_name_prefix="calendar")
+
+
+def get_pool_stats():
+    ''' Get the statistics of the pool of calendar sessions '''
+
+    return CALENDAR_POOL.get_stats()
 
 
 
 def remote_calendar(calendar_uri):
-    """Create a remote calendar with User-Agent set appropriately"""
-    return opentimestamps.calendar.RemoteCalendar(calendar_uri,
-                                                  user_agent="OpenTimestamps-Client/%s"
-                                                  % otsclient.__version__)
+    """Create a remote calendar with User-Agent set appropriately,
+    using the keep-alive sessions of the calendar pool"""
+    return SessionCalendar(calendar_uri, CALENDAR_POOL.get_session(calendar_uri),
+                           user_agent="OpenTimestamps-Client/%s" % otsclient.__version__)
 
 
-def create_timestamp(timestamp, calendar_urls, min_resp, timeout):
+def create_timestamp(timestamp, calendar_urls, min_resp, timeout, grace=DEF_GRACE):
     """Create a timestamp
 
     calendar_urls - List of calendar's to use
+
+    It returns as soon as min_resp calendars answered, waiting at most grace
+    seconds more for the others, then the requests not started yet are cancelled
+    and the answers of the running ones are ignored: each running request
+    still holds its SUBMIT_POOL worker until it ends or fails on its own
+    per-request timeout (see SessionCalendar.submit).
     """
 
 
+    # leave out the calendars with open circuit, unless they are needed for min_resp
+    registry = health.get_registry()
+    calendar_urls = registry.select(calendar_urls, min_resp, default_timeout=timeout)
+
     n_cals = len(calendar_urls)
     msg = "Doing %d-of-%d request, timeout %d sec." % (min_resp, n_cals, timeout)
     logging.debug(msg)
 
-    q_cals = Queue()
-    for calendar_url in calendar_urls:
-        submit_async(calendar_url, timestamp.msg, q_cals, timeout)
+    pending = set(submit_async(calendar_url, timestamp.msg,
+                               registry.get_timeout(calendar_url, timeout))
+                  for calendar_url in calendar_urls)
 
     start = time.time()
+    deadline = start + timeout
     merged = 0
-    for _ in range(n_cals):
-        try:
-            remaining = max(0, timeout - (time.time() - start))
-            result = q_cals.get(block=True, timeout=remaining)
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            # Timeout
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
             try:
-                if isinstance(result, Timestamp):
-                    timestamp.merge(result)
-                    merged += 1
-                else:
-                    logging.debug(str(result))
+                timestamp.merge(future.result())
+                merged += 1
             except Exception as error:
                 logging.debug(str(error))
+        if merged >= min_resp:
+            deadline = min(deadline, time.time() + grace)
 
-        except Empty:
-            # Timeout
-            continue
+    for future in pending:
+        future.cancel()
 
     if merged < min_resp:
         msg = "Failed to create timestamp: need at least %d attestation%s " \
@@ -84,61 +239,83 @@ def create_timestamp(timestamp, calendar_urls, min_resp, timeout):
         logging.error(msg)
         return False
 
-    msg = "%.2f seconds elapsed" % (time.time()-start)
+    msg = "%.2f seconds elapsed, %d of %d calendars" % (time.time()-start, merged, n_cals)
     logging.debug(msg)
     return True
 
 
-def submit_async(calendar_url, message, q_cals, timeout):
-    ''' async call to calendar '''
-
-    def submit_async_thread(remote, message, q_cals, timeout):
-        ''' async thread '''
-
-        try:
-            calendar_timestamp = remote.submit(message, timeout=timeout)
-            q_cals.put(calendar_timestamp)
-        except Exception as exc:
-            q_cals.put(exc)
+def submit_async(calendar_url, message, timeout):
+    ''' async call to calendar, return a Future of its Timestamp,
+        the request is bounded by timeout even if nobody waits for it '''
 
     msg = 'Submitting to remote calendar %s' % calendar_url
     logging.info(msg)
     remote = remote_calendar(calendar_url)
-    t_cal = threading.Thread(target=submit_async_thread, args=(remote, message, q_cals, timeout))
-    t_cal.start()
+    return SUBMIT_POOL.submit(health.get_registry().call, calendar_url,
+                              remote.submit, message, timeout=timeout)
 
 
-def ots_stamp(file_list, min_resp=DEF_MIN_RESP, timeout=DEF_TIMEOUT):
-    ''' stamp function '''
+def stamp_timestamps(file_timestamps, min_resp=DEF_MIN_RESP, timeout=DEF_TIMEOUT):
+    ''' stamp many detached timestamps with a single merkle tip '''
 
     merkle_roots = []
-    file_timestamps = []
-
-    for file_name in file_list:
-        with open(file_name, 'rb') as file_handler:
-            try:
-                file_timestamp = DetachedTimestampFile.from_fd(OpSHA256(), file_handler)
-            except OSError as exp:
-                msg = "Could not read %r: %s" % (file_name, exp)
-                logging.error(msg)
-                raise
-
+    for file_timestamp in file_timestamps:
         # nonce
         nonce_appended_stamp = file_timestamp.timestamp.ops.add(OpAppend(os.urandom(16)))
         merkle_root = nonce_appended_stamp.ops.add(OpSHA256())
-
         merkle_roots.append(merkle_root)
-        file_timestamps.append(file_timestamp)
 
     merkle_tip = make_merkle_tree(merkle_roots)
 
-    calendar_urls = []
-    calendar_urls.append('https://a.pool.opentimestamps.org')
-    calendar_urls.append('https://b.pool.opentimestamps.org')
-    calendar_urls.append('https://a.pool.eternitywall.com')
-    calendar_urls.append('https://ots.btc.catallaxy.com')
+    return create_timestamp(merkle_tip, CALENDAR_URLS, min_resp, timeout)
+
+
+def serialize_timestamp(file_timestamp):
+    ''' get the bytes of the ots file of a detached timestamp '''
+
+    ctx = BytesSerializationContext()
+    file_timestamp.serialize(ctx)
+    return ctx.getbytes()
+
+
+def ots_stamp_digests(digests, min_resp=DEF_MIN_RESP, timeout=DEF_TIMEOUT):
+    ''' stamp a list of sha256 digests with a single calendars round trip,
+        return the list of ots files content or None '''
+
+    file_timestamps = [DetachedTimestampFile(OpSHA256(), Timestamp(digest))
+                       for digest in digests]
+
+    if not stamp_timestamps(file_timestamps, min_resp, timeout):
+        return None
+
+    return [serialize_timestamp(file_timestamp) for file_timestamp in file_timestamps]
+
+
+def ots_stamp(file_list, min_resp=DEF_MIN_RESP, timeout=DEF_TIMEOUT, digests=None):
+    ''' stamp function,
+        digests is an optional list of dicts (hashname: digest), one for each file,
+        a file is not read when its sha256 digest is provided '''
+
+    file_timestamps = []
+
+    if digests is None:
+        digests = [None] * len(file_list)
 
-    if not create_timestamp(merkle_tip, calendar_urls, min_resp, timeout):
+    for file_name, file_digests in zip(file_list, digests):
+        if file_digests and HASHNAME in file_digests:
+            file_timestamp = DetachedTimestampFile(OpSHA256(), Timestamp(file_digests[HASHNAME]))
+        else:
+            with open(file_name, 'rb') as file_handler:
+                try:
+                    file_timestamp = DetachedTimestampFile.from_fd(OpSHA256(), file_handler)
+                except OSError as exp:
+                    msg = "Could not read %r: %s" % (file_name, exp)
+                    logging.error(msg)
+                    raise
+
+        file_timestamps.append(file_timestamp)
+
+    if not stamp_timestamps(file_timestamps, min_resp, timeout):
         return False
 
     for (file_name, file_timestamp) in zip(file_list, file_timestamps):
@@ -184,6 +361,50 @@ def get_attestations_list(stamp):
 
 
 
+def directly_verified(stamp):
+    ''' yield the sub timestamps with attestations '''
+
+    if stamp.attestations:
+        yield stamp
+    else:
+        for result_stamp in stamp.ops.values():
+            yield from directly_verified(result_stamp)
+    yield from ()
+
+
+def get_attestations(stamp):
+    ''' get the set of all the attestations of a timestamp '''
+
+    return set(attest for _, attest in stamp.all_attestations())
+
+
+def get_upgraded_stamp(calendar_url, commitment, unreachable):
+    ''' get the upgraded timestamp of a commitment from a calendar or None,
+        skipping unreachable calendars '''
+
+    registry = health.get_registry()
+    if calendar_url in unreachable or not registry.allow(calendar_url):
+        return None
+    msg = "Checking calendar %s for %s" % (calendar_url, b2x(commitment))
+    logging.debug(msg)
+    try:
+        return registry.call(calendar_url, remote_calendar(calendar_url).get_timestamp,
+                             commitment, timeout=registry.get_timeout(calendar_url, DEF_TIMEOUT),
+                             ok_errors=opentimestamps.calendar.CommitmentNotFoundError)
+    except opentimestamps.calendar.CommitmentNotFoundError as exp:
+        msg = "Calendar %s: %s" % (calendar_url, exp.reason)
+        logging.warning(msg)
+    except OSError as exp:
+        # do not insist with the other commitments of an unreachable calendar
+        unreachable.add(calendar_url)
+        msg = "Calendar %s: %s" % (calendar_url, getattr(exp, 'reason', exp))
+        logging.warning(msg)
+    except DeserializationError as exp:
+        msg = "Calendar %s: bad timestamp: %s" % (calendar_url, exp)
+        logging.warning(msg)
+    return None
+
+
 def upgrade_timestamp(timestamp):
     """Attempt to upgrade an incomplete timestamp to make it verifiable
 
@@ -193,72 +414,160 @@ def upgrade_timestamp(timestamp):
     be returned as nothing has changed.
     """
 
-    def directly_verified(stamp):
-        if stamp.attestations:
-            yield stamp
-        else:
-            for result_stamp in stamp.ops.values():
-                yield from directly_verified(result_stamp)
-        yield from ()
-
-    def get_attestations(stamp):
-        #return set(attest for msg, attest in stamp.all_attestations())
-        return set(attest for _, attest in stamp.all_attestations())
-
-
-    changed = False
-    existing_atts = get_attestations(timestamp)
-    if not is_timestamp_complete(timestamp):
-        # Check remote calendars for upgrades.
-        #
-        # This time we only check PendingAttestations - we can't be as
-        # agressive.
+    return upgrade_timestamps([timestamp])[0]
+
+
+def get_pending_commitments(timestamps):
+    ''' Group the pending commitments of incomplete timestamps by calendar:
+        {calendar uri: {commitment: [(timestamp index, sub timestamp), ...]}} '''
+
+    # This time we only check PendingAttestations - we can't be as
+    # agressive.
+    pending = {}
+    for index, timestamp in enumerate(timestamps):
+        if is_timestamp_complete(timestamp):
+            continue
         for sub_stamp in directly_verified(timestamp):
             for attestation in sub_stamp.attestations:
                 if attestation.__class__ == PendingAttestation:
-                    commitment = sub_stamp.msg
-                    #for calendar_url in calendar_urls:
-                    for calendar_url in [attestation.uri]:
-                        msg = "Checking calendar %s for %s" % (attestation.uri, b2x(commitment))
-                        logging.debug(msg)
-                        calendar = remote_calendar(calendar_url)
-
-                        try:
-                            upgraded_stamp = calendar.get_timestamp(commitment)
-                        except opentimestamps.calendar.CommitmentNotFoundError as exp:
-                            msg = "Calendar %s: %s" % (attestation.uri, exp.reason)
-                            logging.warning(msg)
-                            continue
-                        except urllib.error.URLError as exp:
-                            msg = "Calendar %s: %s" % (attestation.uri, exp.reason)
-                            logging.warning(msg)
-                            continue
-
-                        atts_from_remote = get_attestations(upgraded_stamp)
-                        if atts_from_remote:
-                            msg = "Got %d attestation(s) from %s" % \
-                                    (len(atts_from_remote), calendar_url)
-                            logging.info(msg)
-                            for att in get_attestations(upgraded_stamp):
-                                msg = "    %r" % att
-                                logging.debug(msg)
-
-                        new_atts = get_attestations(upgraded_stamp).difference(existing_atts)
-                        if new_atts:
-                            changed = True
-                            existing_atts.update(new_atts)
-
-                            # FIXME: need to think about DoS attacks here
-                            #args.cache.merge(upgraded_stamp)
-                            sub_stamp.merge(upgraded_stamp)
+                    commitments = pending.setdefault(attestation.uri, {})
+                    commitments.setdefault(sub_stamp.msg, []).append((index, sub_stamp))
+    return pending
+
+
+def get_upgraded_stamps(jobs):
+    ''' Get the upgraded timestamp (or None) of each (calendar_url, commitment, ...)
+        in jobs, querying the calendars concurrently '''
+
+    counts = {}
+    for calendar_url, _, _ in jobs:
+        counts[calendar_url] = counts.get(calendar_url, 0) + 1
+    # an executor for each calendar: the commitments of a busy calendar
+    # never hold the workers that would query the other ones
+    pools = {calendar_url: ThreadPoolExecutor(max_workers=min(count, CALENDAR_CONCURRENCY),
+                                              thread_name_prefix="upgrade")
+             for calendar_url, count in counts.items()}
+    unreachable = set()
+    try:
+        futures = [pools[calendar_url].submit(get_upgraded_stamp, calendar_url, commitment,
+                                              unreachable)
+                   for calendar_url, commitment, _ in jobs]
+        return [future.result() for future in futures]
+    finally:
+        for pool in pools.values():
+            pool.shutdown()
+
+
+def upgrade_timestamps(timestamps):
+    ''' Attempt to upgrade many incomplete timestamps all together:
+        pending commitments are grouped by calendar, each one is fetched once
+        and merged into every timestamp referencing it (timestamps stamped
+        in the same batch share them).
+        The calendars are queried concurrently, each one by its own
+        CALENDAR_CONCURRENCY workers, and their results are merged in the
+        order of the timestamps: the result does not depend on the timing.
+        Returns the list of changed flags, one for each timestamp '''
+
+    existing_atts = [get_attestations(timestamp) for timestamp in timestamps]
+    changed = [False] * len(timestamps)
+
+    # Check remote calendars for upgrades, concurrently, merging the results in a fixed order
+    jobs = [(calendar_url, commitment, sub_stamps)
+            for calendar_url, commitments in get_pending_commitments(timestamps).items()
+            for commitment, sub_stamps in commitments.items()]
+    if not jobs:
+        return changed
+    upgraded_stamps = get_upgraded_stamps(jobs)
+
+    for (calendar_url, _, sub_stamps), upgraded_stamp in zip(jobs, upgraded_stamps):
+        if upgraded_stamp is None:
+            continue
+
+        atts_from_remote = get_attestations(upgraded_stamp)
+        if atts_from_remote:
+            msg = "Got %d attestation(s) from %s" % (len(atts_from_remote), calendar_url)
+            logging.info(msg)
+            for att in atts_from_remote:
+                msg = "    %r" % att
+                logging.debug(msg)
 
+        for index, sub_stamp in sub_stamps:
+            new_atts = atts_from_remote.difference(existing_atts[index])
+            if new_atts:
+                changed[index] = True
+                existing_atts[index].update(new_atts)
+
+                # FIXME: need to think about DoS attacks here
+                #args.cache.merge(upgraded_stamp)
+                sub_stamp.merge(upgraded_stamp)
 
     return changed
 
 
+def ots_upgrade_datas(datas):
+    ''' upgrade the contents of many ots files all together, datas is a list
+        of (name, content), return the list of new contents, None if unchanged '''
 
+    detached_timestamps = []
+    for name, data in datas:
+        try:
+            detached_timestamps.append(load_timestamp(data, name))
+        except (BadMagicError, DeserializationError):
+            detached_timestamps.append(None)
 
+    loaded = [detached for detached in detached_timestamps if detached is not None]
+    changed = iter(upgrade_timestamps([detached.timestamp for detached in loaded]))
 
+    new_datas = []
+    for detached_timestamp in detached_timestamps:
+        if detached_timestamp is not None and next(changed):
+            new_datas.append(serialize_timestamp(detached_timestamp))
+        else:
+            new_datas.append(None)
+    return new_datas
+
+
+
+
+
+
+
+def load_timestamp(data, name="ots"):
+    ''' get the detached timestamp from the content of an ots file '''
+
+    try:
+        ctx = BytesDeserializationContext(data)
+        return DetachedTimestampFile.deserialize(ctx)
+    except BadMagicError:
+        msg = "Error! %r is not a timestamp file" % name
+        logging.error(msg)
+        raise
+    except DeserializationError as exp:
+        msg = "Invalid timestamp file %r: %s" % (name, exp)
+        logging.error(msg)
+        raise
+
+
+def get_file_hashname(data):
+    ''' get the name of the hash algorithm of the target of an ots file content '''
+
+    return load_timestamp(data).file_hash_op.TAG_NAME
+
+
+def ots_upgrade_data(data, name="ots", upgrade=True):
+    ''' upgrade the content of an ots file, calendars are not queried if not upgrade,
+        return (status, attestations, new content or None if unchanged) '''
+
+    detached_timestamp = load_timestamp(data, name)
+    changed = upgrade_timestamp(detached_timestamp.timestamp) if upgrade else False
+    new_data = serialize_timestamp(detached_timestamp) if changed else None
+
+    if is_timestamp_complete(detached_timestamp.timestamp):
+        logging.info("Success! Timestamp complete")
+        return ('UPGRADED', get_attestations_list(detached_timestamp.timestamp), new_data)
+
+    logging.warning("Failed! Timestamp not complete")
+    return ('PENDING', None, new_data)
 
 
 def ots_upgrade(filename):
@@ -269,40 +578,24 @@ def ots_upgrade(filename):
 
     try:
         with open(filename, 'rb') as old_stamp_fd:
-            ctx = StreamDeserializationContext(old_stamp_fd)
-            detached_timestamp = DetachedTimestampFile.deserialize(ctx)
-
+            data = old_stamp_fd.read()
     except IOError as exp:
         msg = "Could not read file %s: %s" % (filename, exp)
         logging.error(msg)
         raise
-    except BadMagicError:
-        msg = "Error! %r is not a timestamp file" % filename
-        logging.error(msg)
-        raise
-    except DeserializationError as exp:
-        msg = "Invalid timestamp file %r: %s" % (filename, exp)
-        logging.error(msg)
-        raise
 
-    changed = upgrade_timestamp(detached_timestamp.timestamp)
+    status, attestations, new_data = ots_upgrade_data(data, filename)
 
-    if changed:
+    if new_data is not None:
         try:
-            with open(old_stamp_fd.name, 'wb') as new_stamp_fd:
-                ctx = StreamSerializationContext(new_stamp_fd)
-                detached_timestamp.serialize(ctx)
+            with open(filename, 'wb') as new_stamp_fd:
+                new_stamp_fd.write(new_data)
         except IOError as exp:
-            msg = "Could not upgrade timestamp %s: %s" % (old_stamp_fd.name, exp)
+            msg = "Could not upgrade timestamp %s: %s" % (filename, exp)
             logging.error(msg)
             raise
 
-    if is_timestamp_complete(detached_timestamp.timestamp):
-        logging.info("Success! Timestamp complete")
-        return ('UPGRADED', get_attestations_list(detached_timestamp.timestamp))
-
-    logging.warning("Failed! Timestamp not complete")
-    return ('PENDING', None)
+    return (status, attestations)
 
 
 
@@ -310,12 +603,13 @@ def ots_upgrade(filename):
 
 
 
-def verify_timestamp(timestamp):
+def verify_timestamp(timestamp, upgrade=True):
     ''' verify an ots '''
 
 
     #args.calendar_urls = []
-    upgrade_timestamp(timestamp)
+    if upgrade:
+        upgrade_timestamp(timestamp)
 
     def attestation_key(item):
         (_, attestation) = item
@@ -341,31 +635,55 @@ def verify_timestamp(timestamp):
     return good, results
 
 
-def ots_verify(filename_ots):
-    ''' verify an ots file '''
+def ots_verify_data(data, digests, name="ots", upgrade=True):
+    ''' verify the content of an ots file given the digests of its target,
+        calendars are not queried if not upgrade,
+        return (status, attestations, new content or None if not upgraded) '''
 
-    try:
-        with open(filename_ots, 'rb') as ots_fd:
-            ctx = StreamDeserializationContext(ots_fd)
-            detached_timestamp = DetachedTimestampFile.deserialize(ctx)
-    except BadMagicError:
-        msg = "Error! %r is not a timestamp file." % filename_ots
-        logging.error(msg)
-        raise
-    except DeserializationError as exp:
-        msg = "Invalid timestamp file %r: %s" % (filename_ots, exp)
-        logging.error(msg)
-        raise
+    detached_timestamp = load_timestamp(data, name)
 
-    else:
-        if not filename_ots.endswith('.ots'):
-            logging.error('Timestamp filename does not end in .ots')
-            raise Exception
+    hashname = detached_timestamp.file_hash_op.TAG_NAME
+    actual_file_digest = digests.get(hashname) if digests else None
+    if actual_file_digest is None:
+        msg = "Missing %s digest of the target of %r" % (hashname, name)
+        logging.error(msg)
+        raise ValueError(msg)
+    msg = "Got digest %s" % b2x(actual_file_digest)
+    logging.debug(msg)
 
-        target_filename = filename_ots[:-4]
-        msg = "Assuming target filename is %r" % target_filename
+    if actual_file_digest != detached_timestamp.file_digest:
+        msg = "Expected digest %s" % b2x(detached_timestamp.file_digest)
         logging.debug(msg)
+        logging.error("File does not match original!")
+        return ("CORRUPTED", None, None)
+
+    changed = upgrade_timestamp(detached_timestamp.timestamp) if upgrade else False
+    new_data = serialize_timestamp(detached_timestamp) if changed else None
+    good, results = verify_timestamp(detached_timestamp.timestamp, upgrade=False)
+    if good:
+        return ("UPGRADED", results, new_data)
+    return ("PENDING", None, new_data)
+
+
+def ots_verify(filename_ots, digests=None):
+    ''' verify an ots file,
+        the target file is not read if its digest is in digests '''
 
+    with open(filename_ots, 'rb') as ots_fd:
+        data = ots_fd.read()
+    file_hash_op = load_timestamp(data, filename_ots).file_hash_op
+    hashname = file_hash_op.TAG_NAME
+
+    if not filename_ots.endswith('.ots'):
+        logging.error('Timestamp filename does not end in .ots')
+        raise Exception
+
+    target_filename = filename_ots[:-4]
+    msg = "Assuming target filename is %r" % target_filename
+    logging.debug(msg)
+
+    digests = dict(digests) if digests else {}
+    if hashname not in digests:
         try:
             target_fd = open(target_filename, 'rb')
         except IOError as exp:
@@ -373,23 +691,13 @@ def ots_verify(filename_ots):
             logging.error(msg)
             raise
 
-        msg = "Hashing file, algorithm %s" % detached_timestamp.file_hash_op.TAG_NAME
+        msg = "Hashing file, algorithm %s" % hashname
         logging.debug(msg)
-        actual_file_digest = detached_timestamp.file_hash_op.hash_fd(target_fd)
+        digests[hashname] = file_hash_op.hash_fd(target_fd)
         target_fd.close()
-        msg = "Got digest %s" % b2x(actual_file_digest)
-        logging.debug(msg)
-
-        if actual_file_digest != detached_timestamp.file_digest:
-            msg = "Expected digest %s" % b2x(detached_timestamp.file_digest)
-            logging.debug(msg)
-            logging.error("File does not match original!")
-            return ("CORRUPTED", None)
 
-    good, results = verify_timestamp(detached_timestamp.timestamp)
-    if good:
-        return ("UPGRADED", results)
-    return ("PENDING", None)
+    status, attestations, _ = ots_verify_data(data, digests, filename_ots)
+    return (status, attestations)
 
 
 
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2019 The TimeBags developers
+#
+# This file is part of the TimeBags software.
+#
+# It is subject to the license terms in the LICENSE file
+# found in the top-level directory of this distribution.
+#
+# No part of the TimeBags software, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms
+# contained in the LICENSE file.
+
+'''
+This file belong to [TimeBags Project](https://timebags.org)
+
+Keep-alive requests sessions of the remote endpoints (TSAs and calendars),
+each one keeping up to max_connections open connections to a single host.
+'''
+
+import requests
+
+
+
+def new_session(max_connections):
+    ''' Get a session keeping up to max_connections connections to one host '''
+
+    session = requests.Session()
+    # the same adapter for http and https
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_connections(session):
+    ''' Get the number of connections opened by session '''
+
+    connections = 0
+    for adapter in set(session.adapters.values()):
+        # the container of the pools can not be iterated
+        for key in adapter.poolmanager.pools.keys():
+            connections += adapter.poolmanager.pools[key].num_connections
+    return connections
@@ -18,6 +18,10 @@ import ctypes
 import tsa_keystore
 
 
+# configuration dir to use instead of the default one, e.g. by the tests
+CONF_DIR = None
+
+
 def tsa_yaml():
     ''' Get the TSA configuration filename '''
 
@@ -31,6 +35,8 @@ def freetsa_pem():
 def path_conf_dir():
     ''' Get the conf dir full pathname '''
 
+    if CONF_DIR is not None:
+        return CONF_DIR
     home = os.path.expanduser("~")
     prefix = '.' if os.name != 'nt' else ''
     return os.path.join(home, prefix + "timebags")
@@ -30,54 +30,412 @@ openssl ts -verify -data Readme.md -in timestamp.tst -CAfile freetsa.pem -partia
 '''
 
 import os
+import time
+import json
+import base64
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from struct import unpack
 import logging
+import requests
 from rfc3161ng import RemoteTimestamper, get_timestamp, check_timestamp, TimeStampToken
-from rfc3161ng.api import load_certificate
+from rfc3161ng import MessageImprint, TimeStampReq
+from rfc3161ng.types import TSAPolicyId
+from rfc3161ng.api import load_certificate, data_to_digest, get_hash_oid
+from rfc3161ng.api import encode_timestamp_request, decode_timestamp_response, TimestampingError
+from cryptography import x509
 from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.backends import default_backend
 from cryptography.x509.ocsp import _OIDS_TO_HASH as HASH
-from pyasn1.codec.der import decoder
+from pyasn1.codec.der import decoder, encoder
+from pyasn1.error import PyAsn1Error
+from pyasn1_modules import rfc2459
 import yaml
 
 import settings
+import health
+import sessions
+
+
+CHUNK_SIZE = 1024 * 1024
+
+# bytes of dataobjects hashed and time spent, see add_hash_stats()
+HASH_STATS = {'bytes': 0, 'seconds': 0.0}
+HASH_STATS_LOCK = threading.Lock()
+
+
+# seconds to wait for a TSA before sending the request to the next one too,
+# None to wait for each TSA: hedging is opt in (timebags --hedge-delay),
+# it can spend more TSA requests
+HEDGE_DELAY = None
+TSA_POOL = ThreadPoolExecutor(max_workers=8)
+# keep-alive connections to each TSA
+TSA_CONNECTIONS = 8
+
+# the configured TSAs, see get_tsa_registry()
+TSA_REGISTRY = None
+TSA_REGISTRY_LOCK = threading.Lock()
 
-def get_token(data):
-    ''' Call a Remote TimeStamper to obtain a ts token of data '''
 
-    tst = None
-    tsa_url = None
-    with open(settings.tsa_yaml()) as tsa_list_fh:
-        tsa_list = yaml.load(tsa_list_fh, Loader=yaml.FullLoader)
 
-        for tsa in tsa_list:
-            tsa_pathfile = os.path.join(settings.path_tsa_dir(), tsa['tsacrt'])
+class TSARegistry():
+    ''' The TSAs configured in tsa.yaml with their parsed certificates '''
+
+    def __init__(self, yaml_pathfile, tsa_dir):
+        ''' Load yaml_pathfile, the certificates are in tsa_dir '''
+
+        self.yaml_pathfile = yaml_pathfile
+        with open(yaml_pathfile, mode='r', encoding='utf-8') as tsa_list_fh:
+            self.tsa_list = yaml.load(tsa_list_fh, Loader=yaml.FullLoader)
+
+        # [(tsa, certificate bytes, x509 certificate), ...] of the TSAs with a certificate
+        self.certificates = []
+        # certificate bytes by (issuer DER, serial number) and by key identifier
+        self.by_issuer_serial = {}
+        self.by_key_id = {}
+        pathfiles = [yaml_pathfile]
+        for tsa in self.tsa_list:
+            tsa_pathfile = os.path.join(tsa_dir, tsa['tsacrt'])
+            pathfiles.append(tsa_pathfile)
             if not os.path.isfile(tsa_pathfile):
                 msg = "TSA cert file missing for %s" % tsa['url']
                 logging.info(msg)
                 continue
             with open(tsa_pathfile, 'rb') as tsa_fh:
-                certificate = tsa_fh.read()
-            timestamper = RemoteTimestamper(tsa['url'],
-                                            certificate=certificate, cafile=tsa['cacrt'],
-                                            hashname=tsa['hashname'], timeout=tsa['timeout'],
-                                            username=tsa['username'], password=tsa['password'],
-                                            include_tsa_certificate=tsa['include_tsa_cert'])
-            nonce = unpack('<q', os.urandom(8))[0]
-
-            msg = "try using TSA endpoint %s to timestamp data" % tsa['url']
-            logging.debug(msg)
+                crt = tsa_fh.read()
+            try:
+                cert = load_certificate(None, crt)
+            except ValueError as err:
+                msg = "Bad TSA cert file for %s: %s" % (tsa['url'], err)
+                logging.warning(msg)
+                continue
+            self.certificates.append((tsa, crt, cert))
+            self.by_issuer_serial[(cert.issuer.public_bytes(default_backend()),
+                                   cert.serial_number)] = crt
+            self.by_key_id[get_key_identifier(cert)] = crt
+
+        # a missing certificate is watched too, to load it when it is added
+        self.mtimes = get_mtimes(pathfiles)
+
+    def get_signer(self, tst):
+        ''' Get the certificate of the configured TSA that signed tst, None if
+            unknown: by the issuer and serial number of the signer, or by the key
+            identifier of the signer certificate embedded in tst (e.g. renewed
+            with the same key), embedded certificates are never trusted '''
+
+        signed_data = tst.content
+        # a token without signer is not signed by anyone
+        if not signed_data['signerInfos'].hasValue() or len(signed_data['signerInfos']) == 0:
+            return None
+        signer = signed_data['signerInfos'][0]['issuerAndSerialNumber']
+        issuer_serial = (encoder.encode(signer['issuer']), int(signer['serialNumber']))
+        crt = self.by_issuer_serial.get(issuer_serial)
+        if crt is not None or not signed_data['certificates'].hasValue():
+            return crt
+
+        for certificate in signed_data['certificates']:
             try:
-                tst = timestamper.timestamp(data=data, nonce=nonce)
+                cert = x509.load_der_x509_certificate(encoder.encode(certificate[0]),
+                                                      default_backend())
+            except (ValueError, PyAsn1Error):
+                continue
+            if (cert.issuer.public_bytes(default_backend()), cert.serial_number) == issuer_serial:
+                return self.by_key_id.get(get_key_identifier(cert))
+        return None
+
+    def is_stale(self, yaml_pathfile):
+        ''' Check if the configuration changed since it was loaded '''
+
+        return yaml_pathfile != self.yaml_pathfile or get_mtimes(self.mtimes) != self.mtimes
+
+
+def get_key_identifier(cert):
+    ''' Get the subject key identifier of a x509 certificate,
+        from its extension or, if missing, from its public key '''
+
+    try:
+        return cert.extensions.get_extension_for_class(x509.SubjectKeyIdentifier).value.digest
+    except x509.ExtensionNotFound:
+        return x509.SubjectKeyIdentifier.from_public_key(cert.public_key()).digest
+
+
+def get_mtimes(pathfiles):
+    ''' Get {pathfile: mtime_ns}, None for missing files '''
+
+    mtimes = {}
+    for pathfile in pathfiles:
+        try:
+            mtimes[pathfile] = os.stat(pathfile).st_mtime_ns
+        except OSError:
+            mtimes[pathfile] = None
+    return mtimes
+
+
+def get_tsa_registry():
+    ''' Get the configured TSAs, parsed once and reloaded only when
+        tsa.yaml or a certificate file is changed '''
+
+    global TSA_REGISTRY # pylint: disable=W0603
+    with TSA_REGISTRY_LOCK:
+        if TSA_REGISTRY is None or TSA_REGISTRY.is_stale(settings.tsa_yaml()):
+            TSA_REGISTRY = TSARegistry(settings.tsa_yaml(), settings.path_tsa_dir())
+            msg = "Loaded %d TSAs, %d with certificate" \
+                    % (len(TSA_REGISTRY.tsa_list), len(TSA_REGISTRY.certificates))
+            logging.debug(msg)
+        return TSA_REGISTRY
+
+
+def get_hashnames():
+    ''' Get the hash algorithms used by the configured TSAs '''
+
+    return [tsa['hashname'] for tsa in get_tsa_registry().tsa_list]
+
+
+class SessionTimestamper(RemoteTimestamper):
+    ''' RemoteTimestamper posting through a requests.Session,
+        to reuse the same connections to the TSA for many requests,
+        the parts of the request that do not change are built once '''
+
+    def __init__(self, url, session=None, **kwargs):
+        super().__init__(url, **kwargs)
+        self.session = session if session is not None else requests.Session()
+        self.requests = 0
+
+        # request template
+        self.algorithm_identifier = rfc2459.AlgorithmIdentifier()
+        self.algorithm_identifier.setComponentByPosition(0, get_hash_oid(self.hashname))
+        self.headers = {'Content-Type': 'application/timestamp-query'}
+        if self.username is not None:
+            username = self.username.encode() if not isinstance(self.username, bytes) \
+                        else self.username
+            password = self.password.encode() if not isinstance(self.password, bytes) \
+                        else self.password
+            self.headers['Authorization'] = "Basic %s" % \
+                    base64.standard_b64encode(b'%s:%s' % (username, password)).decode()
+
+    def make_request(self, digest, nonce=None, include_tsa_certificate=None, tsa_policy_id=None):
+        ''' Get the DER of a TimeStampReq of digest from the template,
+            the options are the ones of the timestamper if None '''
+
+        if len(digest) != hashlib.new(self.hashname).digest_size:
+            raise ValueError("%s digest length is wrong: %d" % (self.hashname, len(digest)))
+        message_imprint = MessageImprint()
+        message_imprint.setComponentByPosition(0, self.algorithm_identifier)
+        message_imprint.setComponentByPosition(1, digest)
+        request = TimeStampReq()
+        request.setComponentByPosition(0, 'v1')
+        request.setComponentByPosition(1, message_imprint)
+        if tsa_policy_id is None:
+            tsa_policy_id = self.tsa_policy_id
+        if tsa_policy_id:
+            request.setComponentByPosition(2, TSAPolicyId(tsa_policy_id))
+        if nonce is not None:
+            request.setComponentByPosition(3, int(nonce))
+        if include_tsa_certificate is None:
+            include_tsa_certificate = self.include_tsa_certificate
+        request.setComponentByPosition(4, include_tsa_certificate)
+        return encode_timestamp_request(request)
+
+    # the arguments of RemoteTimestamper and a timeout
+    def __call__(self, data=None, digest=None, include_tsa_certificate=None, nonce=None, # pylint: disable=R0913,R0917
+                 return_tsr=False, tsa_policy_id=None, timeout=None):
+        ''' same as RemoteTimestamper.__call__() but using self.session and the
+            request template, timeout is the one of the timestamper if None '''
+
+        if data:
+            digest = data_to_digest(data, self.hashname)
+
+        try:
+            response = self.session.post(self.url,
+                                         data=self.make_request(digest, nonce,
+                                                                include_tsa_certificate,
+                                                                tsa_policy_id),
+                                         timeout=timeout if timeout else self.timeout,
+                                         headers=self.headers)
+            response.raise_for_status()
+        except requests.RequestException as exc:
+            raise TimestampingError('Unable to send the request to %r' % self.url, exc) from exc
+        finally:
+            self.requests += 1
+        tsr = decode_timestamp_response(response.content)
+        self.check_response(tsr, digest, nonce=nonce)
+        if return_tsr:
+            return tsr
+        return encoder.encode(tsr.time_stamp_token)
+
+    def timestamp(self, data=None, digest=None, include_tsa_certificate=None, nonce=None, # pylint: disable=R0913,R0917
+                  tsa_policy_id=None, timeout=None):
+        ''' same as RemoteTimestamper.timestamp() with a timeout '''
+
+        return self(data=data, digest=digest, include_tsa_certificate=include_tsa_certificate,
+                    nonce=nonce, tsa_policy_id=tsa_policy_id, timeout=timeout)
+
+    def get_stats(self):
+        ''' Get requests, connections opened and requests on a reused connection '''
+
+        connections = sessions.get_connections(self.session)
+        return {'requests': self.requests, 'connections': connections,
+                'reused': max(self.requests - connections, 0)}
+
+    def close(self):
+        ''' close the connections of the session '''
+
+        self.session.close()
+
+
+
+class TimestamperPool():
+    ''' Process wide pool of keep-alive timestampers, one for each TSA,
+        shared by threads and reused among bags, a timestamper is built
+        again only when the configuration of its TSA changes '''
+
+    def __init__(self, max_connections=TSA_CONNECTIONS):
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        self.timestampers = {} # url: (tsa, certificate, timestamper)
+
+    def get_timestampers(self, certificates):
+        ''' Get a list of (tsa, timestamper) for the TSAs in certificates,
+            [(tsa, certificate bytes, x509 certificate), ...] '''
+
+        timestampers = []
+        with self.lock:
+            old_timestampers, self.timestampers = self.timestampers, {}
+            for tsa, certificate, _ in certificates:
+                entry = old_timestampers.pop(tsa['url'], None)
+                if entry is None or entry[0:2] != (tsa, certificate):
+                    if entry is not None:
+                        entry[2].close()
+                    entry = (tsa, certificate, self.new_timestamper(tsa, certificate))
+                self.timestampers[tsa['url']] = entry
+                timestampers.append((tsa, entry[2]))
+            # TSAs removed from the configuration
+            for _, _, timestamper in old_timestampers.values():
+                timestamper.close()
+        return timestampers
+
+    def new_timestamper(self, tsa, certificate):
+        ''' Build the timestamper of a TSA with its keep-alive session '''
+
+        return SessionTimestamper(tsa['url'], session=sessions.new_session(self.max_connections),
+                                  certificate=certificate, cafile=tsa['cacrt'],
+                                  hashname=tsa['hashname'], timeout=tsa['timeout'],
+                                  username=tsa['username'], password=tsa['password'],
+                                  include_tsa_certificate=tsa['include_tsa_cert'])
+
+    def get_stats(self):
+        ''' Get the stats of the timestamper of each TSA url '''
+
+        with self.lock:
+            return {url: timestamper.get_stats()
+                    for url, (_, _, timestamper) in self.timestampers.items()}
+
+    def close(self):
+        ''' Close all the timestampers '''
+
+        with self.lock:
+            for _, _, timestamper in self.timestampers.values():
+                timestamper.close()
+            self.timestampers = {}
+
+
+TIMESTAMPER_POOL = TimestamperPool()
+
+
+def get_timestampers():
+    ''' Get a list of (tsa, timestamper) for the TSAs configured with a certificate,
+        from the pool of keep-alive timestampers '''
+
+    return TIMESTAMPER_POOL.get_timestampers(get_tsa_registry().certificates)
+
+
+def get_pool_stats():
+    ''' Get the statistics of the pool of TSA timestampers '''
+
+    return TIMESTAMPER_POOL.get_stats()
+
+
+def request_token(registry, tsa, timestamper, data, digest):
+    ''' Request a ts token to a TSA, return it or None if it failed or is not valid '''
+
+    nonce = unpack('<q', os.urandom(8))[0]
+    timeout = registry.get_timeout(tsa['url'], tsa['timeout'])
+    msg = "try using TSA endpoint %s to timestamp data, timeout %.1f sec." % (tsa['url'], timeout)
+    logging.debug(msg)
+    # a plain RemoteTimestamper has only the timeout it was built with
+    options = {'timeout': timeout} if isinstance(timestamper, SessionTimestamper) else {}
+    try:
+        if digest is not None:
+            return registry.call(tsa['url'], timestamper, digest=digest, nonce=nonce, **options)
+        return registry.call(tsa['url'], timestamper, data=data, nonce=nonce, **options)
 # TODO: does the timestamp method compare result with current datetime?
 # rfc3161ng.get_timestamp(tst) must be very close to current datetime
-            except RuntimeError as err:
-                logging.debug(err)
-            except InvalidSignature:
-                msg = "Invalid signature in timestamp from %s" % tsa['url']
-                logging.info(msg)
-            else:
-                tsa_url = tsa['url']
-                break
+    except RuntimeError as err:
+        logging.debug(err)
+    except ValueError as err:
+        msg = "Invalid timestamp from %s: %s" % (tsa['url'], err)
+        logging.info(msg)
+    except InvalidSignature:
+        msg = "Invalid signature in timestamp from %s" % tsa['url']
+        logging.info(msg)
+    return None
+
+
+def get_token(data=None, digests=None, timestampers=None, hedge_delay=HEDGE_DELAY, parallel=1):
+    ''' Call a Remote TimeStamper to obtain a ts token of data,
+        or of its digest when digests (hashname: digest) are provided:
+        the message imprint is built from the digest, data is not needed,
+        timestampers are the pooled ones if None (see get_timestampers).
+        The request is sent to the parallel healthiest TSAs at once, then to
+        the next one when a TSA fails or after hedge_delay seconds without
+        a token (None to wait for each TSA): the first valid token wins.
+        The requests still queued are cancelled, the ones in flight to
+        the slower TSAs finish in the background and their tokens are dropped '''
+
+    tst = None
+    tsa_url = None
+    if timestampers is None:
+        timestampers = get_timestampers()
+
+    # the healthiest TSAs first, the ones with open circuit only if none is left
+    registry = health.get_registry()
+    candidates = []
+    for tsa, timestamper in registry.select(timestampers, key=lambda item: item[0]['url']):
+        digest = digests.get(tsa['hashname']) if digests else None
+        if digest is None and not data:
+            msg = "no %s digest for TSA %s" % (tsa['hashname'], tsa['url'])
+            logging.info(msg)
+            continue
+        candidates.append((tsa, timestamper, digest))
+
+    candidates = iter(candidates)
+    pending = {}
+    def send_next():
+        candidate = next(candidates, None)
+        if candidate is not None:
+            tsa, timestamper, digest = candidate
+            future = TSA_POOL.submit(request_token, registry, tsa, timestamper, data, digest)
+            pending[future] = tsa['url']
+
+    for _ in range(max(parallel, 1)):
+        send_next()
+    while pending and tst is None:
+        done, _ = wait(pending, timeout=hedge_delay, return_when=FIRST_COMPLETED)
+        if not done:
+            msg = "no token after %.1f sec., hedging with the next TSA" % hedge_delay
+            logging.debug(msg)
+            send_next()
+        for future in done:
+            url = pending.pop(future)
+            if tst is None and future.result() is not None:
+                tst, tsa_url = future.result(), url
+            elif tst is None:
+                send_next()
+
+    # the slower TSAs are not waited for, only the queued requests can be cancelled
+    for future in pending:
+        future.cancel()
 
     if tst is not None:
         msg = "TSA %s timestamped dataobject at: %s" % (tsa_url, get_timestamp(tst))
@@ -89,63 +447,222 @@ def get_token(data):
     return (None, None, None)
 
 
+def get_tokens(digests_list, hedge_delay=HEDGE_DELAY, parallel=1):
+    ''' Get a ts token for each dict of digests in the list,
+        reusing the same TSA connections for all of them '''
+
+    timestampers = get_timestampers()
+    tokens = [get_token(digests=digests, timestampers=timestampers,
+                        hedge_delay=hedge_delay, parallel=parallel)
+              for digests in digests_list]
+    msg = "TSA pool: %s" % get_pool_stats()
+    logging.debug(msg)
+    return tokens
+
+
+def hash_leaf(digest, hashname):
+    ''' Hash a dataobject digest into a leaf of a merkle tree '''
+
+    return hashlib.new(hashname, b'\x00' + digest).digest()
+
+
+def hash_node(left, right, hashname):
+    ''' Hash two nodes of a merkle tree into their parent '''
+
+    return hashlib.new(hashname, b'\x01' + left + right).digest()
+
+
+def get_merkle_proofs(digests, hashname):
+    ''' Build a merkle tree over a list of digests, return its root and,
+        for each digest, its inclusion path [(side, sibling hex), ...]
+        from the leaf up, side is the side of the sibling ('L' or 'R') '''
+
+    level = [hash_leaf(digest, hashname) for digest in digests]
+    paths = [[] for _ in digests]
+    positions = list(range(len(digests)))
+    while len(level) > 1:
+        for leaf, position in enumerate(positions):
+            sibling = position ^ 1
+            # the last node of an odd level goes up as it is
+            if sibling < len(level):
+                paths[leaf].append(('L' if sibling < position else 'R', level[sibling].hex()))
+            positions[leaf] = position // 2
+        level = [hash_node(level[i], level[i + 1], hashname) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0], paths
+
+
+def get_merkle_root(digest, path, hashname):
+    ''' Get the root of a merkle tree from a digest and its inclusion path '''
+
+    node = hash_leaf(digest, hashname)
+    for side, sibling in path:
+        sibling = bytes.fromhex(sibling)
+        if side == 'L':
+            node = hash_node(sibling, node, hashname)
+        elif side == 'R':
+            node = hash_node(node, sibling, hashname)
+        else:
+            raise ValueError("bad side in inclusion path: %r" % side)
+    return node
+
+
+def get_batch_token(digests_list, hedge_delay=HEDGE_DELAY, parallel=1):
+    ''' Get a single ts token for many dataobjects, given a dict of digests
+        (hashname: digest) for each one: the token is on the root of a merkle
+        tree of their digests, return (tst, date_time, tsa_url, [proof, ...])
+        as get_token() does or (None, None, None, None), a proof is the json
+        of the hashname and inclusion path of a dataobject '''
+
+    trees = {}
+    for hashname in set(get_hashnames()):
+        if all(hashname in digests for digests in digests_list):
+            trees[hashname] = get_merkle_proofs([digests[hashname] for digests in digests_list],
+                                                hashname)
+
+    token, date_time, tsa_url = get_token(digests={hashname: root for hashname, (root, _)
+                                                   in trees.items()},
+                                          hedge_delay=hedge_delay, parallel=parallel)
+    if token is None:
+        return (None, None, None, None)
+
+    hashname = get_hashname(token)
+    msg = "TSA batch token for %d dataobjects" % len(digests_list)
+    logging.info(msg)
+    return (token, date_time, tsa_url, [json.dumps({'hashname': hashname, 'path': path}).encode()
+                                        for path in trees[hashname][1]])
+
+
 def get_info(tst):
     ''' Fetch timestamp and TSA info from token '''
 
     return (get_timestamp(tst), get_tsa_common_name(tst))
 
 
-def verify_tst(tst_pf, dat_pf):
-    ''' Verify timestamp token '''
-
-    # TODO: Verify tst whenever it is possible.
-    #       Generally I can verify a tst previously generated by others
-    #       only if I have a trusted copy of the certificate of the TSA
-    #       that issued the time stamp token.
-    #       EU QTSP are listed in public lists with their certs.
-    #       A trusted copy of the root CA certificate is needed too.
+def hash_data(dat_pf, hashname):
+    ''' Hash a file in chunks, with constant memory, accounting HASH_STATS '''
 
+    start = time.time()
+    nbytes = 0
+    hashobj = hashlib.new(hashname)
     with open(dat_pf, mode='rb') as dat_fd:
-        dat = dat_fd.read()
+        for chunk in iter(lambda: dat_fd.read(CHUNK_SIZE), b''):
+            hashobj.update(chunk)
+            nbytes += len(chunk)
+    add_hash_stats(nbytes, time.time() - start, [hashname])
+    return hashobj.digest()
+
+
+def add_hash_stats(nbytes, elapsed, hashnames):
+    ''' Account nbytes of a dataobject hashed with hashnames in elapsed seconds '''
+
+    with HASH_STATS_LOCK:
+        HASH_STATS['bytes'] += nbytes
+        HASH_STATS['seconds'] += elapsed
+    msg = "hashed %d bytes with %s in %.2f sec (%.1f MB/s)" \
+            % (nbytes, ", ".join(sorted(hashnames)), elapsed, nbytes / max(elapsed, 1e-6) / 1e6)
+    logging.debug(msg)
+
+
+def get_hash_throughput():
+    ''' MB/s achieved hashing dataobjects, since process start '''
+
+    with HASH_STATS_LOCK:
+        return HASH_STATS['bytes'] / max(HASH_STATS['seconds'], 1e-6) / 1e6
 
-    with open(tst_pf, mode='rb') as tst_fd:
-        tst = tst_fd.read()
+
+def decode_token(tst):
+    ''' Get the TimeStampToken from its DER bytes '''
 
     if not isinstance(tst, TimeStampToken):
         tst, substrate = decoder.decode(tst, asn1Spec=TimeStampToken())
         if substrate:
             raise ValueError("extra data after tst")
+    return tst
 
-    hashname = HASH[str(tst.tst_info.message_imprint.hash_algorithm[0])].name
-    msg = "Verify tst <%s> and dat <%s> hash <%s> commonName <%s>" \
-            % (tst_pf, dat_pf, hashname, get_tsa_common_name(tst))
-    logging.debug(msg)
 
-    # FIXME: why geting crt from tst does not work?
-    # crt = load_certificate(tst.content, b'')
-    ret = False
-    with open(settings.tsa_yaml()) as tsa_list_fh:
-        tsa_list = yaml.load(tsa_list_fh, Loader=yaml.FullLoader)
+def get_hashname(tst):
+    ''' Get the name of the hash algorithm of the token message imprint '''
 
-        for tsa in tsa_list:
-            tsa_pathfile = os.path.join(settings.path_tsa_dir(), tsa['tsacrt'])
-            if not os.path.isfile(tsa_pathfile):
-                msg = "TSA cert file missing for %s" % tsa['url']
-                logging.info(msg)
-                continue
+    tst = decode_token(tst)
+    return HASH[str(tst.tst_info.message_imprint.hash_algorithm[0])].name
 
-            with open(tsa_pathfile, 'rb') as tsa_fh:
-                crt = tsa_fh.read()
 
-            try:
-                ret = check_timestamp(tst, data=dat, certificate=crt, hashname=hashname)
-                break
-            except ValueError as err:
-                msg = "ValueError: %s" % str(err)
-                logging.critical(msg)
-            except InvalidSignature:
-                msg = "InvalidSignature"
-                logging.critical(msg)
+def verify_tst(tst_pf, dat_pf, digests=None, proof_pf=None):
+    ''' Verify timestamp token file,
+        the dataobject is hashed in chunks only if its digest is not in digests,
+        proof_pf is the inclusion proof file of a batch token (see get_batch_token) '''
+
+    with open(tst_pf, mode='rb') as tst_fd:
+        tst = tst_fd.read()
+    proof = None
+    if proof_pf is not None:
+        with open(proof_pf, mode='rb') as proof_fd:
+            proof = proof_fd.read()
+
+    return verify_token(tst, digests, dat_pf, proof)
+
+
+def verify_token(tst, digests, dat_pf=None, proof=None):
+    ''' Verify timestamp token given the digests of its dataobject,
+        if the digest is missing then dat_pf is hashed to get it,
+        a batch token is verified on the merkle root given by proof '''
+
+    # TODO: Verify tst whenever it is possible.
+    #       Generally I can verify a tst previously generated by others
+    #       only if I have a trusted copy of the certificate of the TSA
+    #       that issued the time stamp token.
+    #       EU QTSP are listed in public lists with their certs.
+    #       A trusted copy of the root CA certificate is needed too.
+
+    tst = decode_token(tst)
+    hashname = get_hashname(tst)
+    msg = "Verify tst with dat <%s> hash <%s> commonName <%s>" \
+            % (dat_pf, hashname, get_tsa_common_name(tst))
+    logging.debug(msg)
+
+    digest = digests.get(hashname) if digests else None
+    if digest is None:
+        if dat_pf is None:
+            msg = "no %s digest of dataobject to verify tst" % hashname
+            logging.critical(msg)
+            return False
+        digest = hash_data(dat_pf, hashname)
+
+    # a batch token is on the root of the merkle tree including the dataobject
+    if proof is not None:
+        try:
+            proof = json.loads(proof.decode())
+            if proof['hashname'] != hashname:
+                raise ValueError("proof hash %s is not the tst one" % proof['hashname'])
+            digest = get_merkle_root(digest, proof['path'], hashname)
+        except (ValueError, KeyError, TypeError) as err:
+            msg = "Bad inclusion proof of tst: %s" % err
+            logging.critical(msg)
+            return False
+
+    # a dataobject not matching the token does not need any signature check
+    if bytes(tst.tst_info.message_imprint.hashed_message) != digest:
+        msg = "Message imprint mismatch: dat <%s> is not the data of tst" % dat_pf
+        logging.critical(msg)
+        return False
+
+    # the certificate of the signer, a single signature check whatever the number of TSAs
+    crt = get_tsa_registry().get_signer(tst)
+    if crt is None:
+        msg = "tst signer <%s> is not a configured TSA" % get_tsa_common_name(tst)
+        logging.critical(msg)
+        return False
+
+    ret = False
+    try:
+        ret = check_timestamp(tst, digest=digest, certificate=crt, hashname=hashname)
+    except ValueError as err:
+        msg = "ValueError: %s" % str(err)
+        logging.critical(msg)
+    except InvalidSignature:
+        msg = "InvalidSignature"
+        logging.critical(msg)
 
     return ret
 
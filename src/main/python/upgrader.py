@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2019 The TimeBags developers
+#
+# This file is part of the TimeBags software.
+#
+# It is subject to the license terms in the LICENSE file
+# found in the top-level directory of this distribution.
+#
+# No part of the TimeBags software, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms
+# contained in the LICENSE file.
+
+'''
+This file belong to [TimeBags Project](https://timebags.org)
+
+Background upgrader of the pending timebags.
+
+The bags are taken from the index of bags (see bagindex.py) when their
+next check is due: it is scheduled from the age of their stamps and the
+usual bitcoin confirmation delay, with an exponential backoff, so the
+calendars are queried only when an upgrade is likely.
+Due bags are upgraded in bulk (see asic.upgrade_batch), each pending
+commitment is fetched once, and written back, then the upgrader sleeps
+until the next one is due.
+'''
+
+import os
+import time
+import logging
+import threading
+
+import asic
+import tst
+import ots
+import bagindex
+
+
+BATCH_SIZE = 100
+MAX_SLEEP = 3600
+
+
+
+class Upgrader():
+    ''' Upgrade the pending bags of the index when they are due '''
+
+    def __init__(self, bags=None, batch_size=BATCH_SIZE):
+        ''' bags is the index of bags, the default one if None '''
+
+        self.bags = bags if bags is not None else bagindex.get_index()
+        self.batch_size = batch_size
+        self.stop_event = threading.Event()
+        self.stats = {'checked': 0, 'upgraded': 0, 'missing': 0, 'failed': 0}
+
+
+    def run_once(self, now=None):
+        ''' Process the bags due by now, return how many were processed '''
+
+        rows = self.bags.due(now)[0:self.batch_size]
+        containers = [self.open_bag(row['path']) for row in rows]
+        containers = [container for container in containers if container is not None]
+        if containers and not self.stop_event.is_set():
+            self.upgrade(containers)
+        return len(rows)
+
+
+    def open_bag(self, pathfile):
+        ''' Get the ASiCS of a bag, None if it is no more a bag to upgrade '''
+
+        if not os.path.isfile(pathfile):
+            msg = "Bag %s is missing, removed from the index" % pathfile
+            logging.warning(msg)
+            self.bags.remove(pathfile)
+            self.stats['missing'] += 1
+            return None
+
+        container = asic.ASiCS(pathfile, deep=False)
+        if not container.valid:
+            msg = "Bag %s is not a valid ASiC-S anymore, removed from the index" % pathfile
+            logging.warning(msg)
+            self.bags.remove(pathfile)
+            return None
+        # the dataobject of a bag not changed since its last check is not read again
+        container.use_index(self.bags)
+        return container
+
+
+    def upgrade(self, containers):
+        ''' Upgrade the ots of the bags all together and write them back '''
+
+        self.stats['checked'] += len(containers)
+        try:
+            results = asic.upgrade_batch(containers)
+        except Exception as exp: # pylint: disable=W0703
+            # a bag must not stop the others: process them one by one
+            msg = "Failed upgrading %d bags together: %s" % (len(containers), exp)
+            logging.error(msg)
+            results = [self.upgrade_one(container) for container in containers]
+
+        for container, result in zip(containers, results):
+            if result == 'UPGRADED':
+                self.stats['upgraded'] += 1
+            msg = "Upgrader: %s %s" % (container.pathfile, result)
+            logging.info(msg)
+
+
+    def upgrade_one(self, container):
+        ''' Process the timestamps of a bag, return its result or None '''
+
+        try:
+            return container.process_timestamps(force=True)
+        except Exception as exp: # pylint: disable=W0703
+            # try again at its next check
+            msg = "Failed upgrading %s: %s" % (container.pathfile, exp)
+            logging.error(msg)
+            self.stats['failed'] += 1
+            self.bags.record(container.pathfile, container.status)
+            return None
+
+
+    def get_sleep(self, now=None):
+        ''' Get the seconds to sleep before the next bag is due '''
+
+        if now is None:
+            now = time.time()
+        next_wakeup = self.bags.next_wakeup()
+        if next_wakeup is None:
+            return MAX_SLEEP
+        return min(max(next_wakeup - now, 0), MAX_SLEEP)
+
+
+    def run(self):
+        ''' Upgrade the bags when they are due, until stop() '''
+
+        logging.info("Upgrader started")
+        while not self.stop_event.is_set():
+            # a full batch means that more bags could be due already
+            if self.run_once() < self.batch_size:
+                self.stop_event.wait(self.get_sleep())
+        msg = "Upgrader stopped: %s, calendar pool: %s, hashing: %.1f MB/s" \
+                % (self.stats, ots.get_pool_stats(), tst.get_hash_throughput())
+        logging.info(msg)
+
+
+    def stop(self):
+        ''' Stop run() '''
+
+        self.stop_event.set()
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2019 The TimeBags developers
+#
+# This file is part of the TimeBags software.
+#
+# It is subject to the license terms in the LICENSE file
+# found in the top-level directory of this distribution.
+#
+# No part of the TimeBags software, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms
+# contained in the LICENSE file.
+
+'''
+This file belong to [TimeBags Project](https://timebags.org)
+
+Low level zip helpers, to move members between zip archives
+without decompressing and compressing them again, and to update
+a zip in place appending members and a new central directory
+'''
+
+import os
+import time
+import contextlib
+import struct
+import zipfile
+import logging
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+CHUNK_SIZE = 1024 * 1024
+JOURNAL = ".journal"
+LOCK_OFFSET = 2 ** 30
+
+
+
+def write_raw(fh_zip, zinfo, raw):
+    ''' write an already compressed member, like ZipFile.mkdir() does,
+        raw is bytes or a file object to copy zinfo.compress_size bytes from '''
+
+    # pylint: disable=W0212
+    with fh_zip._lock:
+        if fh_zip._writing:
+            raise ValueError("Can't write to ZIP archive while an open writing handle exists")
+        zinfo.header_offset = fh_zip.fp.tell()
+        fh_zip._writecheck(zinfo)
+        fh_zip._didModify = True
+        fh_zip.fp.write(zinfo.FileHeader(None))
+        if isinstance(raw, bytes):
+            fh_zip.fp.write(raw)
+        else:
+            remaining = zinfo.compress_size
+            while remaining > 0:
+                chunk = raw.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    raise OSError("unexpected end of data for %s" % zinfo.filename)
+                fh_zip.fp.write(chunk)
+                remaining -= len(chunk)
+        fh_zip.filelist.append(zinfo)
+        fh_zip.NameToInfo[zinfo.filename] = zinfo
+        fh_zip.start_dir = fh_zip.fp.tell()
+
+
+def get_data_offset(fd, zinfo):
+    ''' offset of the (compressed) data of a member, after its local header '''
+
+    fd.seek(zinfo.header_offset)
+    header = fd.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[0:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad magic number for file header of %s" % zinfo.filename)
+    len_name, len_extra = struct.unpack('<HH', header[26:30])
+    return zinfo.header_offset + zipfile.sizeFileHeader + len_name + len_extra
+
+
+def copy_member(fh_zip, src_zip, src_info, zinfo=None):
+    ''' copy a member of src_zip into fh_zip as it is, zinfo can give
+        a new name, date_time and attributes to it '''
+
+    if zinfo is None:
+        zinfo = zipfile.ZipInfo(src_info.filename, src_info.date_time)
+        zinfo.external_attr = src_info.external_attr
+    zinfo.compress_type = src_info.compress_type
+    zinfo.CRC = src_info.CRC
+    zinfo.compress_size = src_info.compress_size
+    zinfo.file_size = src_info.file_size
+    src_zip.fp.seek(get_data_offset(src_zip.fp, src_info))
+    write_raw(fh_zip, zinfo, src_zip.fp)
+
+
+
+def update_zip(pathfile, members, comment=None):
+    ''' Update in place the zip pathfile with members [(zinfo, data), ...]:
+        members with a name already in the zip replace the old ones.
+
+        Members and the new central directory are appended after the old one,
+        so the old archive is untouched until the end: the size of the file
+        is journaled before and an interrupted update is rolled back
+        by recover(). The space of replaced members is not reclaimed. '''
+
+    journal_fd = open_journal(pathfile)
+    try:
+        with open(pathfile, mode='r+b') as zip_fd:
+            with zipfile.ZipFile(zip_fd, mode='a') as fh_zip:
+                # pylint: disable=W0212
+                fh_zip.start_dir = int(journal_fd.read())
+                for zinfo, _ in members:
+                    old_info = fh_zip.NameToInfo.pop(zinfo.filename, None)
+                    if old_info is not None:
+                        fh_zip.filelist.remove(old_info)
+                for zinfo, data in members:
+                    fh_zip.writestr(zinfo, data)
+                if comment is not None:
+                    fh_zip.comment = comment
+                fh_zip._didModify = True
+            zip_fd.flush()
+            os.fsync(zip_fd.fileno())
+        close_journal(pathfile, journal_fd)
+    finally:
+        journal_fd.close()
+
+
+def open_journal(pathfile):
+    ''' Create the journal of an update in place of pathfile, locked until
+        it is closed: another process updating pathfile is waited for,
+        an update interrupted by a crash is rolled back first '''
+
+    journal = pathfile + JOURNAL
+    while True:
+        recover(pathfile, wait=True)
+        try:
+            # pylint: disable=R1732
+            journal_fd = open(journal, mode='x+b')
+        except FileExistsError:
+            # another process got it first
+            continue
+        lock(journal_fd, wait=True)
+        # a recover() could have removed it before the lock
+        if is_journal(journal_fd, journal):
+            break
+        journal_fd.close()
+
+    journal_fd.write(str(os.path.getsize(pathfile)).encode('ascii'))
+    journal_fd.flush()
+    os.fsync(journal_fd.fileno())
+    journal_fd.seek(0)
+    return journal_fd
+
+
+def recover(pathfile, wait=False):
+    ''' Roll back an update_zip() interrupted by a crash, return True if done.
+        The update of a process still running is left alone, or waited for
+        if wait is True '''
+
+    journal = pathfile + JOURNAL
+    try:
+        journal_fd = open(journal, mode='r+b')
+    except FileNotFoundError:
+        return False
+
+    with journal_fd:
+        if not lock(journal_fd, wait=wait):
+            msg = "%s is being updated by another process" % pathfile
+            logging.info(msg)
+            return False
+        # the writer is gone: it removed the journal or it crashed
+        if not is_journal(journal_fd, journal):
+            return False
+        size = journal_fd.read()
+        # an incomplete journal means that the zip was not touched yet
+        if size.isdigit():
+            with open(pathfile, mode='r+b') as zip_fd:
+                zip_fd.truncate(int(size))
+                zip_fd.flush()
+                os.fsync(zip_fd.fileno())
+            msg = "Rolled back interrupted update of %s" % pathfile
+            logging.warning(msg)
+        close_journal(pathfile, journal_fd)
+    return True
+
+
+def lock(journal_fd, wait=False):
+    ''' Lock exclusively the open journal_fd, return False if another process
+        holds the lock and wait is False. The lock goes with the process,
+        so the one of a crashed update is released '''
+
+    try:
+        if fcntl is not None:
+            flags = fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB
+            fcntl.flock(journal_fd.fileno(), flags)
+        else:
+            # msvcrt locks a range of bytes, one past any content of a journal
+            journal_fd.seek(LOCK_OFFSET)
+            while True:
+                try:
+                    # pylint: disable=E0601
+                    msvcrt.locking(journal_fd.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    if not wait:
+                        raise
+                    time.sleep(0.1)
+            journal_fd.seek(0)
+    except OSError:
+        return False
+    return True
+
+
+def is_journal(journal_fd, journal):
+    ''' True if journal_fd is still the journal file, not removed or replaced '''
+
+    try:
+        return os.path.samestat(os.fstat(journal_fd.fileno()), os.stat(journal))
+    except FileNotFoundError:
+        return False
+
+
+def close_journal(pathfile, journal_fd):
+    ''' Empty and remove the journal of pathfile, then release its lock
+        closing journal_fd: an empty journal has nothing to roll back '''
+
+    journal_fd.seek(0)
+    journal_fd.truncate()
+    journal_fd.flush()
+    os.fsync(journal_fd.fileno())
+    try:
+        os.remove(pathfile + JOURNAL)
+    except PermissionError:
+        # Windows removes only closed files
+        journal_fd.close()
+        with contextlib.suppress(OSError):
+            os.remove(pathfile + JOURNAL)
+    journal_fd.close()
+
+
+
+class MemberReader():
+    ''' Seekable read only view of the data of a stored member of a zip,
+        to open a nested zip in place, without extracting it '''
+
+    def __init__(self, fd, offset, size):
+        self.fd = fd
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def read(self, size=-1):
+        ''' read up to size bytes '''
+
+        if size is None or size < 0 or size > self.size - self.pos:
+            size = max(0, self.size - self.pos)
+        self.fd.seek(self.offset + self.pos)
+        data = self.fd.read(size)
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        ''' move to offset '''
+
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        ''' current position '''
+
+        return self.pos
+
+    @staticmethod
+    def seekable():
+        ''' it is '''
+
+        return True